@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# Copyright (c) 2019 David Hunter
+""" Compares serial and concurrent retrieval against a fake client with injected latency.
+
+Usage: python benchmarks/bench_fetch.py [--days N] [--latency SECONDS] [--workers N]
+"""
+import argparse
+import tempfile
+from datetime import datetime
+from datetime import timedelta
+
+from common import load_script, time_it
+from fake_fitbit import FakeFitbit
+from fitbit_fetch import FetchEngine, build_tasks
+
+tracker = load_script('fitbit-tracker.py')
+
+
+def run(days, latency, workers):
+    client = FakeFitbit(latency=latency)
+    start = datetime(2019, 1, 1)
+    date_list = [(start + timedelta(days=d)).strftime('%Y-%m-%d') for d in range(days)]
+    with tempfile.TemporaryDirectory() as output_dir:
+        options = {'output_dir': output_dir, 'json': False, 'storage': 'csv'}
+        engine = FetchEngine(tracker.make_fetchers(client, options), max_workers=workers)
+        for _ in engine.run(build_tasks(date_list, 'daily')):
+            pass
+    return (client.calls)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.25)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    serial, calls = time_it(run, args.days, args.latency, 1, repeat=1)
+    concurrent, _ = time_it(run, args.days, args.latency, args.workers, repeat=1)
+    print('requests:            ' + str(calls))
+    print('serial (1 worker):   {:.2f}s'.format(serial))
+    print('concurrent ({} workers): {:.2f}s'.format(args.workers, concurrent))
+    print('speedup:             {:.1f}x'.format(serial / concurrent))
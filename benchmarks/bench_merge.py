@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# Copyright (c) 2019 David Hunter
+""" Compares the per-file pd.merge loop with assemble_frame for building the wide day frame.
+
+assemble_frame aligns the day frames with searchsorted and fills the wide
+frame with fitbit-analysis.py assemble_arrays in one pass.
+
+Reports wall clock time and peak traced memory for each approach on synthetic
+1 second heart rate days with random gaps.
+
+Usage: python benchmarks/bench_merge.py [--days N]
+"""
+import argparse
+import tracemalloc
+from datetime import date
+from datetime import timedelta
+
+import numpy as numpy
+import pandas as pd
+
+from common import load_script, time_it
+
+analysis = load_script('fitbit-analysis.py')
+
+
+def make_days(days, seed=0):
+    """ Returns a list of single column day frames indexed by the time of day. """
+    rng = numpy.random.default_rng(seed)
+    frames = list()
+    start = date(2019, 1, 1)
+    for d in range(days):
+        # Keep roughly 80% of the seconds in the day.
+        secs = numpy.sort(rng.choice(86400, size=69120, replace=False))
+        index = pd.to_timedelta(secs, unit='s')
+        name = (start + timedelta(days=d)).strftime('%Y-%m-%d')
+        frames.append(pd.DataFrame({name: rng.integers(50, 160, size=len(secs))}, index=index))
+    return (frames)
+
+
+def merge_loop(frames, index):
+    """ The original approach: one left merge per file. """
+    merge_df = pd.DataFrame(index=index)
+    for df in frames:
+        merge_df = pd.merge(merge_df, df, left_index=True, right_index=True, how='left')
+    return (merge_df)
+
+
+def assemble_frame(frames, index):
+    """ Aligns a list of single column day dataframes onto the time of day index.
+    Samples that do not fall on the index are dropped, matching a left merge.
+    """
+    # Compare in one unit, pandas may keep the indexes in different ones.
+    index_ns = index.as_unit('ns').asi8
+    columns = list()
+    arrays = list()
+    for df in frames:
+        day_ns = df.index.as_unit('ns').asi8
+        pos = numpy.searchsorted(index_ns, day_ns)
+        pos = numpy.minimum(pos, len(index_ns) - 1)
+        on_grid = index_ns[pos] == day_ns
+        arrays.append((pos[on_grid], df.iloc[:, 0].values[on_grid]))
+        columns.append(df.columns[0])
+    return (analysis.assemble_arrays(columns, arrays, index))
+
+
+def measure(func, frames, index):
+    tracemalloc.start()
+    elapsed, result = time_it(func, frames, index, repeat=1)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (elapsed, peak, result)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=365)
+    args = parser.parse_args()
+
+    frames = make_days(args.days)
+    index = analysis.get_time_index('1s')
+
+    new_time, new_peak, new_df = measure(assemble_frame, frames, index)
+    old_time, old_peak, old_df = measure(merge_loop, frames, index)
+    pd.testing.assert_frame_equal(old_df.astype('float32'), new_df, check_freq=False)
+
+    print('days:            ' + str(args.days))
+    print('pd.merge loop:   {:.2f}s  peak {:.0f} MB'.format(old_time, old_peak / 1e6))
+    print('assemble_frame:  {:.2f}s  peak {:.0f} MB'.format(new_time, new_peak / 1e6))
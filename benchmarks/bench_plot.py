@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# Copyright (c) 2019 David Hunter
+""" Compares drawing every heart rate sample with drawing the min/max of each pixel column.
+
+Renders synthetic 1 second heart rate days with the Agg backend, once with all
+the samples as one line and once reduced by series_figures, then renders a
+figure per month of the reduced samples serially and with a pool of workers.
+
+Usage: python benchmarks/bench_plot.py [--days N] [--workers N]
+"""
+import argparse
+import os
+import tempfile
+
+import numpy as numpy
+import pandas as pd
+
+from common import load_script, time_it
+import fitbit_plot
+
+analysis = load_script('fitbit-analysis.py')
+
+
+def make_frame(days, seed=0):
+    """ Returns a time of day x days heart rate frame with roughly 20% of the seconds missing. """
+    rng = numpy.random.default_rng(seed)
+    index = analysis.get_time_index('1s')
+    values = rng.integers(50, 160, size=(len(index), days)).astype('float32')
+    values[rng.random(values.shape) < 0.2] = numpy.nan
+    columns = pd.date_range('2019-01-01', periods=days, freq='D').strftime('%Y-%m-%d')
+    return (pd.DataFrame(values, index=index, columns=columns))
+
+
+def render_full(merge_df, path):
+    """ Draws every sample of the frame as one line. """
+    plt = fitbit_plot.import_plotting(headless=True)
+    # Without chunking Agg refuses paths this long (cell block limit).
+    plt.rcParams['agg.path.chunksize'] = 10000
+    days = pd.to_datetime(merge_df.columns).values
+    x = (days[:, None] + merge_df.index.values[None, :]).ravel()
+    fig = plt.figure(figsize=fitbit_plot.FIGURE_SIZE, dpi=fitbit_plot.FIGURE_DPI)
+    fig.gca().plot(x, merge_df.values.T.ravel(), 'b-', linewidth=0.5)
+    fig.savefig(path, dpi=fitbit_plot.FIGURE_DPI)
+    plt.close(fig)
+
+
+def render_reduced(merge_df, path):
+    """ Draws the min/max of each pixel column. """
+    fitbit_plot.render_figure(fitbit_plot.series_figures('heartrate', merge_df)[0], path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    merge_df = make_frame(args.days)
+    with tempfile.TemporaryDirectory() as plot_dir:
+        full_time, _ = time_it(render_full, merge_df, os.path.join(plot_dir, 'full.png'), repeat=1)
+        reduced_time, _ = time_it(render_reduced, merge_df, os.path.join(plot_dir, 'reduced.png'), repeat=1)
+        figures = fitbit_plot.series_figures('heartrate', merge_df, 'month')
+        serial_time, _ = time_it(fitbit_plot.render_figures, figures, plot_dir, 'png', 1, repeat=1)
+        pool_time, _ = time_it(fitbit_plot.render_figures, figures, plot_dir, 'png', args.workers, repeat=1)
+
+    print('days:              {}  ({:.1f}M samples)'.format(args.days, merge_df.size / 1e6))
+    print('every sample:      {:.2f}s'.format(full_time))
+    print('min/max per pixel: {:.2f}s'.format(reduced_time))
+    print('{} monthly figures: serial {:.2f}s  {} workers {:.2f}s'.format(
+        len(figures), serial_time, args.workers, pool_time))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# Copyright (c) 2019 David Hunter
+""" Compares the memory of a day held as a json_normalize frame and as an IntradaySeries.
+
+Uses a synthetic full day of 1 second heart rate in the intraday API format and
+scales the per day figures to a year.
+
+Usage: python benchmarks/bench_series.py [--repeat N]
+"""
+import argparse
+
+import pandas as pd
+
+from common import time_it
+from fake_fitbit import heartrate_payload
+from fitbit_series import IntradaySeries, day_timestamps, seconds_of_day
+
+DATE = '2019-01-01'
+
+
+def frame_path(payload):
+    """ The original get_heartrate conversion. """
+    df = pd.json_normalize(payload['activities-heart-intraday'], record_path=['dataset'], sep='_')
+    df['time'] = day_timestamps(DATE, seconds_of_day(df.time.values))
+    return (df)
+
+
+def series_path(payload):
+    return (IntradaySeries.from_dataset(DATE, 'heartrate', payload['activities-heart-intraday']['dataset']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    payload = heartrate_payload(DATE)
+    old_time, df = time_it(frame_path, payload, repeat=args.repeat)
+    new_time, series = time_it(series_path, payload, repeat=args.repeat)
+    assert (series.values == df.value.values).all()
+
+    # The frame as returned by json_normalize, before the times are converted.
+    raw = pd.json_normalize(payload['activities-heart-intraday'], record_path=['dataset'], sep='_')
+    raw_bytes = raw.memory_usage(deep=True).sum()
+    df_bytes = df.memory_usage(deep=True).sum()
+    print('samples:              ' + str(len(series)))
+    print('json_normalize frame: {:.2f} MB/day  {:.0f} MB/year'.format(raw_bytes / 1e6, raw_bytes * 365 / 1e6))
+    print('timestamp frame:      {:.2f} MB/day  {:.0f} MB/year'.format(df_bytes / 1e6, df_bytes * 365 / 1e6))
+    print('IntradaySeries:       {:.2f} MB/day  {:.0f} MB/year'.format(series.nbytes / 1e6, series.nbytes * 365 / 1e6))
+    print('build time:           frame {:.1f} ms, series {:.1f} ms'.format(old_time * 1000, new_time * 1000))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# Copyright (c) 2019 David Hunter
+""" Measures the start up time of fitbit-analysis.py with python -X importtime.
+
+Runs `fitbit-analysis.py --version`, which imports the module and parses the
+command line but does no work, in fresh interpreters and reports the wall
+clock time, the cumulative import time of the top level imports and the
+slowest of them.  It then measures what the plotting and modeling imports
+(matplotlib, seaborn, statsmodels) add on top of pandas, which every run
+used to pay, and checks that a run that does not plot imports none of them.
+
+Usage: python benchmarks/bench_startup.py [--repeat N] [--top N]
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import time
+
+from common import REPO_DIR
+
+SCRIPT = os.path.join(REPO_DIR, 'fitbit-analysis.py')
+DEFERRED = ['matplotlib.pyplot', 'seaborn', 'statsmodels.api', 'statsmodels.formula.api']
+
+
+def import_times(args):
+    """ Runs python -X importtime with args and returns {top level module: cumulative seconds}. """
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=REPO_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    times = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented below the module importing them.
+        if not name[1:].startswith(' '):
+            times[name.strip()] = int(cumulative) / 1e6
+    return (times)
+
+
+def wall_time(args, repeat):
+    """ Returns the best wall clock time of running python with args. """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    times = import_times([SCRIPT, '--version'])
+    print('fitbit-analysis.py --version  wall {:.2f}s  imports {:.2f}s'.format(
+        wall_time([SCRIPT, '--version'], args.repeat), sum(times.values())))
+    for name, seconds in sorted(times.items(), key=lambda item: -item[1])[:args.top]:
+        print('    {:30s} {:.3f}s'.format(name, seconds))
+
+    eager = [name for name in DEFERRED if importlib.util.find_spec(name.split('.')[0]) is not None]
+    missing = sorted(set(name.split('.')[0] for name in DEFERRED) - set(name.split('.')[0] for name in eager))
+    imported = [name for name in DEFERRED if name in times or name.split('.')[0] in times]
+    assert not imported, 'imported at start up: ' + ', '.join(imported)
+    if eager:
+        # Import pandas first so only what the deferred modules add is counted.
+        code = 'import numpy, pandas, tqdm; import ' + ', '.join(eager)
+        deferred_times = import_times(['-c', code])
+        added = sum(deferred_times.get(name.split('.')[0], 0.0) for name in set(eager))
+        print('deferred {:40s} {:.2f}s'.format(', '.join(eager), added))
+    if missing:
+        print('not installed, not measured: ' + ', '.join(missing))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# Copyright (c) 2019 David Hunter
+""" Compares the seven pass generate_stats_df with the single copy nan_stats kernel.
+
+Uses a synthetic seconds x days float32 frame shaped like the analysis merge
+frame, with about 10% of the samples missing and a few days without any.
+
+Usage: python benchmarks/bench_stats.py [--days N] [--repeat N]
+"""
+import argparse
+import warnings
+
+import numpy as numpy
+import pandas as pd
+
+from common import time_it
+from fitbit_stats import frame_stats
+
+
+def present_idx(df, axis, method):
+    """ Runs idxmin or idxmax on the slices with samples only and reindexes the result.
+    pandas 3 raises ValueError on slices without any samples, where older
+    versions returned NaN.
+    """
+    present = df.notna().any(axis=axis)
+    if axis in ('index', 0):
+        part = df.loc[:, present]
+    else:
+        part = df.loc[present]
+    return (getattr(part, method)(axis=axis).reindex(present.index))
+
+
+def original_stats_df(df, axis):
+    """ The original generate_stats_df. """
+    stats_df = pd.DataFrame()
+    stats_df['Mean'] = df.mean(axis=axis)
+    stats_df['Median'] = df.median(axis=axis)
+    stats_df['Min'] = df.min(axis=axis)
+    stats_df['Max'] = df.max(axis=axis)
+    stats_df['MinIdx'] = present_idx(df, axis, 'idxmin')
+    stats_df['MaxIdx'] = present_idx(df, axis, 'idxmax')
+    stats_df['StdDev'] = df.std(axis=axis)
+    return stats_df
+
+
+def make_frame(days, seed=0):
+    rng = numpy.random.default_rng(seed)
+    grid = rng.integers(50, 160, size=(86400, days)).astype('float32')
+    grid[rng.random(grid.shape) < 0.1] = numpy.nan
+    grid[:, ::50] = numpy.nan
+    index = pd.timedelta_range(start='00:00:00', periods=86400, freq='1s', name='Time')
+    columns = [d.strftime('%Y-%m-%d') for d in pd.date_range('2019-01-01', periods=days)]
+    return (pd.DataFrame(grid, index=index, columns=columns))
+
+
+def check(old, new):
+    """ Compares the two results, ignoring slices without samples where pandas differs by version. """
+    valid = old['Mean'].notna()
+    for column in ['Mean', 'Median', 'Min', 'Max', 'StdDev']:
+        assert numpy.allclose(old[column][valid], new[column][valid], rtol=1e-4), column
+    for column in ['MinIdx', 'MaxIdx']:
+        assert (old[column][valid] == new[column][valid]).all(), column
+    assert new[~valid].drop(columns=['MinIdx', 'MaxIdx']).isna().all().all()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    df = make_frame(args.days)
+    print('frame:  ' + str(df.shape[0]) + ' seconds x ' + str(df.shape[1]) + ' days')
+    for axis in ['index', 'columns']:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            old_time, old = time_it(original_stats_df, df, axis, repeat=args.repeat)
+        new_time, new = time_it(frame_stats, df, axis, repeat=args.repeat)
+        check(old, new)
+        print('axis={:8s} generate_stats_df {:.2f}s  nan_stats {:.2f}s  speedup {:.1f}x'.format(
+            axis, old_time, new_time, old_time / new_time))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# Copyright (c) 2019 David Hunter
+""" Compares the string concatenation and vectorized timestamp construction paths.
+
+Uses a synthetic full day of 1 second heart rate in the intraday API format.
+
+Usage: python benchmarks/bench_timestamps.py [--repeat N]
+"""
+import argparse
+
+import pandas as pd
+
+from common import time_it
+from fake_fitbit import heartrate_payload
+from fitbit_series import day_timestamps, seconds_of_day
+
+DATE = '2019-01-01'
+
+
+def concat_path(df):
+    """ The original get_heartrate/get_steps conversion. """
+    return (pd.to_datetime(DATE + ' ' + df.time.astype(str)))
+
+
+def vectorized_path(df):
+    return (day_timestamps(DATE, seconds_of_day(df.time.values)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payload = heartrate_payload(DATE)
+    df = pd.json_normalize(payload['activities-heart-intraday'], record_path=['dataset'], sep='_')
+
+    old_time, old = time_it(concat_path, df, repeat=args.repeat)
+    new_time, new = time_it(vectorized_path, df, repeat=args.repeat)
+    assert (pd.DatetimeIndex(old) == new).all()
+
+    print('samples:           ' + str(len(df)))
+    print('string concat:     {:.1f} ms'.format(old_time * 1000))
+    print('vectorized:        {:.1f} ms'.format(new_time * 1000))
+    print('speedup:           {:.0f}x'.format(old_time / new_time))
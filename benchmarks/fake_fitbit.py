@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# Copyright (c) 2019 David Hunter
+""" A local stand-in for the fitbit.Fitbit client used by the benchmarks.
+
+Returns synthetic payloads shaped like the Fitbit web API responses the
+tracker consumes and sleeps for a configurable latency on each call so the
+effect of concurrent fetching can be measured without touching the network.
+
+"""
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+
+import numpy as numpy
+
+
+def heartrate_payload(date_str, seed=0):
+    """ Returns a full day of 1 second heart rate samples in the API format. """
+    rng = numpy.random.default_rng(seed)
+    values = rng.integers(50, 160, size=86400)
+    dataset = list()
+    for sec, value in enumerate(values):
+        h, rem = divmod(sec, 3600)
+        m, s = divmod(rem, 60)
+        dataset.append({'time': '%02d:%02d:%02d' % (h, m, s), 'value': int(value)})
+    return ({
+        'activities-heart': [{'dateTime': date_str, 'value': {'restingHeartRate': 60}}],
+        'activities-heart-intraday': {'dataset': dataset, 'datasetInterval': 1, 'datasetType': 'second'}})
+
+
+def steps_payload(date_str, seed=0):
+    """ Returns a full day of 1 minute step counts in the API format. """
+    rng = numpy.random.default_rng(seed)
+    values = rng.integers(0, 120, size=1440)
+    dataset = list()
+    for minute, value in enumerate(values):
+        h, m = divmod(minute, 60)
+        dataset.append({'time': '%02d:%02d:00' % (h, m), 'value': int(value)})
+    return ({
+        'activities-steps': [{'dateTime': date_str, 'value': str(int(values.sum()))}],
+        'activities-steps-intraday': {'dataset': dataset, 'datasetInterval': 1, 'datasetType': 'minute'}})
+
+
+def sleep_payload(date_str, seed=0):
+    """ Returns a single 8 hour main sleep period starting at 23:00 in the v1 API format. """
+    rng = numpy.random.default_rng(seed)
+    values = rng.integers(1, 4, size=480)
+    start = datetime.strptime(date_str, '%Y-%m-%d') + timedelta(hours=23)
+    minute_data = list()
+    for minute, value in enumerate(values):
+        stamp = start + timedelta(minutes=minute)
+        minute_data.append({'dateTime': stamp.strftime('%H:%M:%S'), 'value': str(int(value))})
+    asleep = int((values == 1).sum())
+    return ({
+        'sleep': [{'dateOfSleep': date_str, 'isMainSleep': True, 'minuteData': minute_data,
+                   'startTime': start.strftime('%Y-%m-%dT%H:%M:%S.000'), 'efficiency': 90}],
+        'summary': {'totalMinutesAsleep': asleep, 'totalSleepRecords': 1, 'totalTimeInBed': 480}})
+
+
+class FakeFitbit(object):
+    """ Mimics the subset of fitbit.Fitbit used by fitbit-tracker.py. """
+
+    def __init__(self, latency=0.1):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._cache = dict()
+
+    def _payload(self, key, builder, date_str):
+        with self._lock:
+            self.calls += 1
+            if (key, date_str) not in self._cache:
+                self._cache[(key, date_str)] = builder(date_str)
+            payload = self._cache[(key, date_str)]
+        time.sleep(self.latency)
+        return (payload)
+
+    def time_series(self, resource, user_id=None, base_date='today', period=None, end_date=None):
+        """ Returns a daily series from base_date to end_date inclusive. """
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        start = datetime.strptime(str(base_date), '%Y-%m-%d')
+        days = (datetime.strptime(str(end_date), '%Y-%m-%d') - start).days + 1
+        rng = numpy.random.default_rng(days)
+        entries = list()
+        for day in range(days):
+            date_str = (start + timedelta(days=day)).strftime('%Y-%m-%d')
+            if resource == 'activities/heart':
+                value = {'customHeartRateZones': [], 'heartRateZones': [],
+                         'restingHeartRate': int(rng.integers(50, 70))}
+            else:
+                value = str(int(rng.integers(0, 20000)))
+            entries.append({'dateTime': date_str, 'value': value})
+        return ({resource.replace('/', '-'): entries})
+
+    def intraday_time_series(self, resource, base_date='today', detail_level='1min',
+                             start_time=None, end_time=None):
+        if resource == 'activities/heart':
+            return (self._payload('heart', heartrate_payload, str(base_date)))
+        elif resource == 'activities/steps':
+            return (self._payload('steps', steps_payload, str(base_date)))
+        raise ValueError('Unsupported resource ' + resource)
+
+    def get_sleep(self, date):
+        return (self._payload('sleep', sleep_payload, date.strftime('%Y-%m-%d')))
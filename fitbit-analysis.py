@@ -31,16 +31,12 @@ from datetime import date
 from datetime import datetime
 from tqdm import tqdm
 
-import matplotlib
-# This allows the saving of .png files.  NB.  This must come before
-# import the pyplot library.
-# matplotlib.use("agg")
-from matplotlib.ticker import AutoMinorLocator
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.dates as md
+# matplotlib, seaborn and statsmodels take seconds to import, so they are only
+# imported by the code paths that use them (see fitbit_plot.import_plotting).
 
 import argparse
+import concurrent.futures
+import functools
 import io
 import os
 import os.path
@@ -51,13 +47,15 @@ import json
 
 import pandas as pd
 import numpy as numpy
-import seaborn as sns
+from fitbit_cube import HeartRateCube
+from fitbit_daystats import DayStatsTable
+from fitbit_interpolate import fill_gaps, interpolate_frame
+from fitbit_plot import PLOT_FORMATS, PLOT_PERIODS, render_figures, series_figures, show_figures, summary_figures
+from fitbit_series import IntradaySeries
+from fitbit_sleep import sleep_heartrate, sleep_per_minute
+from fitbit_stats import frame_stats
+from fitbit_storage import BACKENDS, FileCatalog, get_date, get_resource, get_storage, read_data_file
 # import pandas_profiling
-import statsmodels.api as sm
-import statsmodels.formula.api as smf
-
-from pandas.plotting import register_matplotlib_converters
-register_matplotlib_converters()
 
 # Globals
 __AUTHOR__ = 'David Hunter'
@@ -117,6 +115,33 @@ def set_command_options():
         help='Generate simple summary plot of the data.',
         dest='plot_stats',
         action='store_true')
+    parser.add_argument(
+        '--plot_dir',
+        help='Render the plots to files in this directory instead of showing them.  Needs no display.',
+        action='store',
+        type=str,
+        dest='plot_dir')
+    parser.add_argument(
+        '--plot_format',
+        help='File format of the plots rendered to --plot_dir. (default: %(default)s)',
+        action='store',
+        type=str,
+        choices=PLOT_FORMATS,
+        dest='plot_format',
+        default='png')
+    parser.add_argument(
+        '--plot_period',
+        help='Plot the whole range in one figure per resource or a figure per year or month. (default: %(default)s)',
+        action='store',
+        type=str,
+        choices=sorted(PLOT_PERIODS),
+        dest='plot_period',
+        default='all')
+    parser.add_argument(
+        '--plot_series',
+        help='Also plot every sample of each resource, reduced to the minimum and maximum of each pixel column.',
+        action='store_true',
+        dest='plot_series')
     parser.add_argument(
         '-e',
         '--end_date',
@@ -132,8 +157,41 @@ def set_command_options():
         dest='stats',
         type=str,
         default='min')
+    parser.add_argument(
+        '--storage',
+        help='Format of the per-day data files written by fitbit-tracker.py. (default: %(default)s)',
+        action='store',
+        type=str,
+        choices=sorted(BACKENDS),
+        dest='storage',
+        default='csv')
+    parser.add_argument(
+        '--rescan',
+        help='Rebuild the catalog of data files from the output directory before reading it, e.g. after files were rewritten in place.',
+        action='store_true',
+        dest='rescan')
+    parser.add_argument(
+        '--cube',
+        help='Read heart rate from the memory-mapped cube built by fitbit_cube.py instead of the day files.',
+        action='store_true',
+        dest='cube')
     msg = 'Interpolate missing heartrate data based on surrounding values in the same day.'
     parser.add_argument('-i', '--interpolate', help=msg, action='store_true')
+    parser.add_argument(
+        '--max_gap',
+        help='Longest gap filled by --interpolate, e.g. 90s or 5min.  Longer gaps stay missing. (default: %(default)s)',
+        action='store',
+        type=str,
+        dest='max_gap',
+        default='5min')
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='Number of processes used to read the data files. (default: number of cpus)',
+        action='store',
+        type=int,
+        dest='workers',
+        default=os.cpu_count())
     type_group.add_argument(
         '-a',
         '--all',
@@ -292,25 +350,56 @@ def get_command_options(parser):
     else:
         options['output_dir'] = args.output_dir
 
+    try:
+        get_storage(args.storage, args.output_dir)
+        options['storage'] = args.storage
+    except ImportError as err:
+        logging.error(str(err) + '  Exiting.')
+        print(str(err))
+        sys.exit(1)
+
     # Use interpolation.  Only viable for heartrate.
-    if args.interpolate and 'heartrate' in args.collect_type:
+    if args.interpolate and 'heartrate' in options['analyze_type']:
+        try:
+            options['max_gap'] = int(pd.Timedelta(args.max_gap).total_seconds())
+        except ValueError:
+            msg = str(args.max_gap) + ' is an invalid maximum gap.  Use e.g. 90s or 5min.  Exiting'
+            logging.error(msg)
+            print(msg)
+            sys.exit(1)
         options['interpolate'] = True
-        msg = 'Using interpolation for heartrate.'
+        msg = 'Using interpolation for heartrate, filling gaps of up to ' + str(options['max_gap']) + ' seconds.'
         logging.info(msg)
     else:
         options['interpolate'] = False
         msg = 'Do not use interpolation.'
         logging.info(msg)
 
+    if args.workers <= 0:
+        msg = 'Number of workers needs to be greater than zero.  Exiting'
+        logging.error(msg)
+        print(msg)
+        sys.exit(1)
+    else:
+        options['workers'] = args.workers
+
+    options['cube'] = args.cube
+    options['rescan'] = args.rescan
+
     if args.retain_files:
         options['retain'] = True
     else:
         options['retain'] = False
 
-    if args.plot_stats:
+    # Rendering to files or plotting the samples implies plotting.
+    if args.plot_stats or args.plot_dir or args.plot_series:
         options['plot_stats'] = True
     else:
         options['plot_stats'] = False
+    options['plot_dir'] = args.plot_dir
+    options['plot_format'] = args.plot_format
+    options['plot_period'] = args.plot_period
+    options['plot_series'] = args.plot_series
 
     logging.debug(json.dumps(options))
     return (options)
@@ -326,40 +415,6 @@ def is_valid_date(date_to_check):
     return (True)
 
 
-def get_dataframe(fname):
-    """ Reads in a file generated by fitbit-tracker, converts the index into a timedelta value
-        and returns the results in a dataframe """
-    df = pd.read_csv(
-        fname,
-        sep=',',
-        header=0,
-        index_col=0,
-        skip_blank_lines=True,
-        dtype={
-            1: 'int32'
-        })
-    df.index = pd.TimedeltaIndex(df.index)
-    # df.index = pd.DatetimeIndex(df.index)
-    return (df)
-
-
-def get_all_file_list(dir_name, fragment):
-    """ Gets a list of files within a directory based on a string in the filename """
-    if os.path.isdir(dir_name):
-        all_files = []
-        list_of_files = os.listdir(dir_name)
-        for file_name in list_of_files:
-            if fragment in file_name:
-                full_path_name = os.path.join(dir_name, file_name)
-                all_files.append(full_path_name)
-        return (all_files)
-    else:
-        logging.error(
-            'Invalid directory provided in get_all_file_list function.  Exiting'
-        )
-        exit(1)
-
-
 def date_range(start, end):
     """ Returns a list of dates """
     r = (end + timedelta(days=1) - start).days
@@ -405,24 +460,97 @@ def get_date_frag(options):
 
     return (date_frag_list)
 
-def create_index_file(fname, start, end, freq):
-    """ Creates an dataframe with an time index and stores it in the passed filename """
-    # TODO(dph): Look at changing this to a TimeDeltaIndex or a DatetimeIndex model
-    rng = pd.date_range(start=start, end=end, freq=freq)
-    base_df = pd.DataFrame(data={'Time': rng.strftime('%H:%M:%S')})
-    base_df.to_csv(fname, columns=['Time'], header=True, index=False)
+# Sampling resolution of each resource.  Heart rate is saved every few seconds
+# but can start on any second, steps are saved once a minute and sleep once a
+# minute starting on either the top or bottom of the minute.
+RESOLUTION = {'heartrate': '1s', 'steps': '1min', 'sleep': '1min'}
+
+
+@functools.lru_cache(maxsize=None)
+def get_time_index(freq):
+    """ Returns a TimedeltaIndex covering every timeslot of a day at the given frequency. """
+    return (pd.timedelta_range(start='00:00:00', end='23:59:59', freq=freq, name='Time'))
+
+def assemble_arrays(columns, arrays, index):
+    """ Builds the wide frame from (positions, values) pairs, one pair per column.
+
+    The values are written into one preallocated array, so building the wide
+    frame costs a single pass over the data rather than a merge per day.  The
+    samples are narrow integers, so float32 holds them exactly at half the
+    memory of float64.
+    """
+    grid = numpy.full((len(index), len(columns)), numpy.nan, dtype='float32')
+    for col, (positions, values) in enumerate(arrays):
+        grid[positions, col] = values
+    return (pd.DataFrame(grid, index=index, columns=columns))
+
+def assemble_mask(columns, arrays, index):
+    """ Builds a boolean frame that is True at the given positions of each column. """
+    grid = numpy.zeros((len(index), len(columns)), dtype='bool')
+    for col, positions in enumerate(arrays):
+        grid[positions, col] = True
+    return (pd.DataFrame(grid, index=index, columns=columns))
+
+def load_day(fname, freq, max_gap=None):
+    """ Reads and classifies a day file.  Runs in the worker processes.
+
+    Returns a tuple of (fname, status, positions, values, synthesized) where
+    status is 'merged', 'empty' or 'all_zeros'.  For merged files positions
+    holds the slot of each sample in the freq time index and values the narrow
+    integer samples of the day's IntradaySeries, which are far cheaper to send
+    back than a dataframe.  If max_gap is given, gaps of up to max_gap slots
+    are filled with fill_gaps, values become float32 and synthesized holds the
+    slots that were filled.
+    """
+    series = IntradaySeries.from_frame(read_data_file(fname), get_resource(fname), get_date(fname))
+    if len(series) == 0:
+        return (fname, 'empty', None, None, None)
+    # if the max is 0 (the values are unsigned) consider the dataframe empty.
+    if series.values.max() == 0:
+        return (fname, 'all_zeros', None, None, None)
+    positions = series.seconds // numpy.uint32(pd.Timedelta(freq).total_seconds())
+    on_grid = positions < len(get_time_index(freq))
+    if max_gap is None:
+        return (fname, 'merged', positions[on_grid], series.values[on_grid], None)
+    positions, values, synthesized = fill_gaps(positions[on_grid], series.values[on_grid], max_gap)
+    return (fname, 'merged', positions, values, synthesized)
+
+def load_files(file_list, workers, max_gaps=None):
+    """ Loads day files with a pool of worker processes, preserving the file order.
+    Each file is read at the RESOLUTION of its resource, so the files of
+    several resources can share one pool.
+    Args:
+      file_list:  List of day files to read
+      workers:    Number of worker processes.  1 reads in this process.
+      max_gaps:   Dict of resource to the longest gap, in slots, to fill
+                  (default: no interpolation)
+    Returns:
+      A list of load_day results in the same order as file_list.
+    """
+    if max_gaps is None:
+        max_gaps = dict()
+    freqs = [RESOLUTION[get_resource(fname)] for fname in file_list]
+    gaps = [max_gaps.get(get_resource(fname)) for fname in file_list]
+    prog_bar = tqdm(total=len(file_list), desc='Reading Files', ascii=True)
+    results = list()
+    if workers <= 1 or len(file_list) <= 1:
+        for fname, freq, max_gap in zip(file_list, freqs, gaps):
+            results.append(load_day(fname, freq, max_gap))
+            prog_bar.update()
+    else:
+        chunksize = max(1, len(file_list) // (workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(load_day, file_list, freqs, gaps, chunksize=chunksize):
+                results.append(result)
+                prog_bar.update()
+    prog_bar.close()
+    return (results)
 
 def generate_stats_df(df, axis):
-    """ Given a dataframe, return a dataframe with stats along the given axis"""
-    stats_df = pd.DataFrame()
-    stats_df['Mean'] = df.mean(axis=axis)
-    stats_df['Median'] = df.median(axis=axis)
-    stats_df['Min'] = df.min(axis=axis)
-    stats_df['Max'] = df.max(axis=axis)
-    stats_df['MinIdx'] = df.idxmin(axis=axis)
-    stats_df['MaxIdx'] = df.idxmax(axis=axis)
-    stats_df['StdDev'] = df.std(axis=axis)
-    return stats_df
+    """ Given a dataframe, return a dataframe with stats along the given axis.
+    The statistics are computed together by fitbit_stats.nan_stats, and days
+    or times without any samples give NaN without a warning. """
+    return (frame_stats(df, axis))
 
 
 def get_sum_of_axis(df, axis):
@@ -431,6 +559,16 @@ def get_sum_of_axis(df, axis):
     return (sum)
 
 
+def cube_day_summary(cube, date_list):
+    """ Returns the generate_stats_df statistics and the Total of each requested day
+    held in the heart rate cube.  The cube is read a block of days at a time, so
+    no days x seconds frame is built and memory stays bounded over years.
+    """
+    summary_df = cube.stats(date_list, 'index')
+    summary_df['Total'] = cube.totals(date_list)
+    return (summary_df)
+
+
 def log_debug_list(_list, prog_msg, log_msg):
     """ Given a list, log it to the debug log file """
     logging.debug(log_msg)
@@ -440,174 +578,286 @@ def log_debug_list(_list, prog_msg, log_msg):
         prog_bar.update()
 
 
+def get_catalog(options):
+    """ Returns the FileCatalog of the output directory.
+    It is scanned on first use, with --rescan, or when day files were added or
+    removed without being recorded (e.g. copied in, or written before the
+    tracker kept a catalog).
+    """
+    catalog = FileCatalog(get_storage(options['storage'], options['output_dir']))
+    if options['rescan'] or not catalog.exists() or catalog.is_stale():
+        print('Cataloguing the data files in ' + options['output_dir'])
+        catalog.scan()
+    return (catalog)
+
+
+FILE_LISTS = ('found', 'missing', 'merged', 'empty', 'all_zeros')
+
+
+def merge_days(options, date_lists):
+    """ Loads the days of each resource into a wide frame with a column per day.
+
+    Every resource keeps its native resolution (see RESOLUTION).  The catalog
+    is read once and the day files of all the resources are read by a single
+    pool of worker processes.
+
+    With the interpolate option, heart rate gaps of up to max_gap seconds
+    between two samples of a day are filled linearly as the days are read (see
+    fitbit_interpolate).  Longer gaps, and the time before the first and after
+    the last sample of a day, stay missing.
+    Args:
+      options:     The command line options dict
+      date_lists:  Dict of resource to the list of yyyy-mm-dd days to load
+    Returns:
+      A dict of resource to a tuple of the frame, a boolean frame marking the
+      interpolated samples (None without interpolation) and a dict of the
+      FILE_LISTS lists of files (of dates when the heart rate cube is read).
+    """
+    max_gaps = dict()
+    if options['interpolate']:
+        max_gaps['heartrate'] = int(options['max_gap'] // pd.Timedelta(RESOLUTION['heartrate']).total_seconds())
+    merged = dict()
+    catalog = None
+    load_list = list()
+
+    for resource, date_list in date_lists.items():
+        # Build an index that contains all timeslots in a day at the resolution of the
+        # resource as the FitBit sampling intervals can vary day to day.
+        time_index = get_time_index(RESOLUTION[resource])
+        files = {name: list() for name in FILE_LISTS}
+
+        if options['cube'] and resource == 'heartrate':
+            # The cube holds every day as one memory-mapped row, so nothing is parsed.
+            cube = HeartRateCube(options['output_dir'])
+            files['merged'], _ = cube.select(date_list)
+            files['found'] = list(files['merged'])
+            files['missing'] = [d for d in date_list if d not in cube]
+            logging.info('Found ' + str(len(files['merged'])) + ' of ' + str(len(date_list)) + ' days in the heart rate cube.')
+            merge_df = cube.to_frame(date_list, time_index)
+            interpolated_df = None
+            if resource in max_gaps:
+                merge_df, interpolated_df = interpolate_frame(merge_df, max_gaps[resource], options['workers'])
+            merged[resource] = (merge_df, interpolated_df, files)
+            continue
+
+        # Look up the file of every day in the requested time period in the
+        # catalog rather than probing the directory for each one.
+        if catalog is None:
+            catalog = get_catalog(options)
+        storage = catalog.storage
+        for frag in date_list:
+            entry = catalog.get(resource, frag)
+            if entry is None:
+                files['missing'].append(storage.path(resource, frag))
+            elif entry['rows'] == 0:
+                files['found'].append(catalog.path(resource, frag))
+                files['empty'].append(catalog.path(resource, frag))
+            else:
+                files['found'].append(catalog.path(resource, frag))
+                load_list.append(catalog.path(resource, frag))
+
+        logging.info('Looked for ' + str(len(date_list)) + ' ' + resource + ' files.')
+        logging.info('Found ' + str(len(files['found'])) + ' files.')
+        logging.info('Missing  ' + str(len(files['missing'])) + ' files.')
+
+        if __DEBUG__:
+            log_debug_list(date_list, 'Writing found fragment list',
+                           'Fragment Files:')
+            log_debug_list(files['found'], 'Writing found file list',
+                           'Found Files:')
+            log_debug_list(files['missing'], 'Writing missing file list',
+                           'Missing Files:')
+        merged[resource] = (None, None, files)
+
+    # Merge the files into a single dataframe per resource, keeping track of what has/has not merged.
+    columns = {resource: list() for resource in merged}
+    arrays = {resource: list() for resource in merged}
+    synthesized_arrays = {resource: list() for resource in merged}
+    for fname, status, positions, values, synthesized in load_files(load_list, options['workers'], max_gaps):
+        resource = get_resource(fname)
+        files = merged[resource][2]
+        if status == 'empty':
+            files['empty'].append(fname)
+        elif status == 'all_zeros':
+            files['all_zeros'].append(fname)
+        else:
+            columns[resource].append(get_date(fname))
+            arrays[resource].append((positions, values))
+            synthesized_arrays[resource].append(synthesized)
+            files['merged'].append(fname)
+
+    for resource, (merge_df, interpolated_df, files) in merged.items():
+        if merge_df is not None:
+            continue
+        time_index = get_time_index(RESOLUTION[resource])
+        merge_df = assemble_arrays(columns[resource], arrays[resource], time_index)
+        if resource in max_gaps:
+            interpolated_df = assemble_mask(columns[resource], synthesized_arrays[resource], time_index)
+        merged[resource] = (merge_df, interpolated_df, files)
+    return (merged)
+
+
+MINUTES_PER_DAY = 1440
+
+
+def minute_means(df):
+    """ Returns a minutes x days float32 array of the mean of each minute of a wide frame. """
+    values = df.values
+    per_minute = len(df.index) // MINUTES_PER_DAY
+    if per_minute == 1:
+        return (values.astype('float32'))
+    blocks = values.reshape(MINUTES_PER_DAY, per_minute, values.shape[1])
+    present = ~numpy.isnan(blocks)
+    count = present.sum(axis=1)
+    total = numpy.where(present, blocks, 0).sum(axis=1, dtype='float64')
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return ((total / count).astype('float32'))
+
+
+def join_per_minute(frames, date_list):
+    """ Joins the wide frames of several resources into one per-minute frame.
+    Args:
+      frames:     Dict of resource to a time of day x days frame at its own resolution
+      date_list:  The yyyy-mm-dd days of the joined frame
+    Returns:
+      A frame indexed by the timestamp of every minute of the days with a
+      column per resource.  Resources sampled more often than once a minute
+      (heart rate) are averaged over the minute, and the part of a night of
+      sleep before midnight is put on the day before the night is reported
+      against.
+    """
+    days = numpy.array(date_list, dtype='datetime64[ns]')
+    minutes = numpy.arange(MINUTES_PER_DAY) * numpy.timedelta64(60, 's')
+    index = pd.DatetimeIndex((days[:, None] + minutes[None, :]).ravel(), name='Time')
+    joined = pd.DataFrame(index=index)
+    for resource, df in frames.items():
+        if resource == 'sleep':
+            # A night reported for a day starts the evening before.
+            joined[resource] = sleep_per_minute(df, date_list)
+        else:
+            grid = pd.DataFrame(minute_means(df), columns=df.columns).reindex(columns=date_list)
+            joined[resource] = grid.values.T.ravel()
+    return (joined)
+
+
 if __name__ == '__main__':
     parser = set_command_options()
     options = get_command_options(parser)
-    index_file = options['output_dir'] + '/intraday_index.csv'
-    found_file_list = list()
-    missing_file_list = list()
-
-    # Create an index file that contains all timeslots in a day as the FitBit sampling intervals can vary day to day.
-    # TODO(dph): Heart rate is saved every 5 seconds, but it can start on any second, so we need to account for all seconds.
-    # TODO(dph): Steps are saved every minute, so we should only create one for every minute 
-    # TODO(dph): Sleep is saved once per minute, but can start either on the top or bottom of the minute (aka: 00 or1)
-    create_index_file(index_file, start='00:00:00', end='23:59:59', freq='S')
-    merge_df = get_dataframe(index_file)
-    merge_df.index = pd.TimedeltaIndex(merge_df.index)
-
-    # Generate a list of all possible filenames during the requested time
-    # period and create a list of valid files.
-    frag_list = get_date_frag(options)
-    prog_bar = tqdm(total=len(frag_list),
-                    desc='Creating file list based on days', ascii=True)
-    for frag in frag_list:
-        if 'heartrate' in options['analyze_type']:
-            f1 = options['output_dir'] + '/hr_intraday_' + str(frag) + '.csv'
 
-        elif 'steps' in options['analyze_type']:
-            f1 = options['output_dir'] + '/steps_intraday_' + str(frag) + '.csv'
-
-        elif 'sleep' in options['analyze_type']:
-            f1 = options['output_dir'] + '/sleep_day_' + str(frag) + '.csv'
+    # Every requested resource is analyzed in this one run.
+    resources = [r for r in RESOLUTION if r in options['analyze_type']]
+    frag_list = get_date_frag(options)
 
-        if os.path.exists(f1):
-            found_file_list.append(f1)
+    # The summary plots only need one row of statistics per day.  Days the
+    # tracker summarized (--day_stats) are read from the daily stats table and
+    # only the day files of the remaining days are loaded.
+    day_summaries = {resource: pd.DataFrame() for resource in resources}
+    date_lists = {resource: frag_list for resource in resources}
+    summary_only = options['plot_stats'] and not options['plot_series'] and not options['interpolate'] and \
+        not options['retain']
+    if summary_only:
+        stats_table = DayStatsTable(get_storage(options['storage'], options['output_dir']))
+        for resource in resources:
+            day_summaries[resource] = stats_table.read(resource, frag_list)
+            date_lists[resource] = [d for d in frag_list if d not in day_summaries[resource].index]
+            logging.info('Read ' + str(len(day_summaries[resource])) + ' of ' + str(len(frag_list)) + ' ' +
+                         resource + ' days from the daily stats table.')
+
+    # The heart rate cube gives the day statistics without building the dense
+    # frame, which is then only loaded when something else needs it.  Interpolated
+    # statistics still come from the filled frame.
+    cube_summary = options['cube'] and options['plot_stats'] and not options['interpolate'] and \
+        'heartrate' in resources
+    if cube_summary:
+        cube_summary_df = cube_day_summary(HeartRateCube(options['output_dir']), date_lists['heartrate'])
+        logging.info('Read ' + str(len(cube_summary_df)) + ' of ' + str(len(date_lists['heartrate'])) +
+                     ' heartrate days from the heart rate cube.')
+        if day_summaries['heartrate'].empty:
+            day_summaries['heartrate'] = cube_summary_df
         else:
-            missing_file_list.append(f1)
-        prog_bar.update()
-
-    logging.info('Looked for ' + str(len(frag_list)) + ' files.')
-    logging.info('Found ' + str(len(found_file_list)) + ' files.')
-    logging.info('Missing  ' + str(len(missing_file_list)) + ' files.')
+            day_summaries['heartrate'] = pd.concat([day_summaries['heartrate'], cube_summary_df]).sort_index()
+        if summary_only:
+            date_lists['heartrate'] = list()
 
-    if __DEBUG__:
-        log_debug_list(frag_list, 'Writing found fragment list',
-                       'Fragment Files:')
-        log_debug_list(found_file_list, 'Writing found file list',
-                       'Found Files:')
-        log_debug_list(missing_file_list, 'Writing missing file list',
-                       'Missing Files:')
-
-    if len(found_file_list) == 0:
+    merged = merge_days(options, {r: d for r, d in date_lists.items() if d})
+    found_count = sum(len(files['found']) for _, _, files in merged.values())
+    if found_count == 0 and all(df.empty for df in day_summaries.values()):
         msg = 'No matching files find for request.'
         print(msg)
         logging.error(msg)
         exit(-1)
 
-    # Merge the files into a single dataframe, keeping track of what has/has not merged.
-    merged_file_list = list()
-    empty_file_list = list()
-    all_zeros_file_list = list()
-
-    prog_bar = tqdm(total=len(found_file_list), desc='Merging Files', ascii=True)
-    for fname in found_file_list:
-        df = get_dataframe(fname)
-        # if the max and min are 0 consider the dataframe empty.
-        for cols in df.columns:
-            df_min = df[cols].min()
-            df_max = df[cols].max()
-        if df.empty:
-            empty_file_list.append(fname)
-        elif df_min == 0 and df_max == 0:
-            all_zeros_file_list.append(fname)
-        else:
-            merge_df = pd.merge(merge_df, df, left_index=True, right_index=True, how='left')
-            merged_file_list.append(fname)
-        prog_bar.update()
+    for resource, (merge_df, interpolated_df, files) in merged.items():
+        logging.info('Merged ' + str(len(files['merged'])) + ' ' + resource + ' files.')
+        logging.info(str(len(files['empty'])) + ' files not merged:')
+        logging.info(str(len(files['all_zeros'])) + ' files with all zeros.')
+
+        if __DEBUG__:
+            log_debug_list(files['merged'], 'Writing merged file list',
+                           'Merged Files: ')
+            log_debug_list(files['empty'], 'Writing empty file list',
+                           'Empty Files: ')
+            log_debug_list(files['all_zeros'], 'Writing list of all zero files',
+                           'Files with all zeros: ')
+
+        # Within the heartrate dataframe, NaaN values were interpolated by merge_days based on
+        # a linear algorithium.  While this may not be 100% accurate, it does assume that the
+        # pace of change is realtively equal between sampled values.
+        #
+        # Note:  We interpolate along the row, aka: time based (axis=0), and only inside
+        # gaps of up to --max_gap, so a device taken off overnight is not filled in.
+        if interpolated_df is not None:
+            msg = 'Interpolated ' + str(int(interpolated_df.values.sum())) + ' samples in gaps of up to ' + \
+                  str(options['max_gap']) + ' seconds.'
+            logging.info(msg)
+            print(msg)
 
-    logging.info('Merged ' + str(len(merged_file_list)) + ' files.')
-    logging.info(str(len(empty_file_list)) + ' files not merged:')
-    logging.info(str(len(all_zeros_file_list)) + ' files with all zeros.')
-
-    if __DEBUG__:
-        log_debug_list(merged_file_list, 'Writing merged file list',
-                       'Merged Files: ')
-        log_debug_list(empty_file_list, 'Writing empty file list',
-                       'Empty Files: ')
-        log_debug_list(all_zeros_file_list, 'Writing list of all zero files',
-                       'Files with all zeros: ')
-
-    # Within the heartrate dataframe, NaaN values  will be interpolated  values based on
-    # a linear algorithium.  While this may not be 100% accurate, it does assume that the
-    # pace of change is realtively equal between sampled values.
-    #
-    # Note:  If we interpolate along the column (axis=1) then we will get go along the lines of
-    # assuming that the next value (fwd or bckwd) would be the logical value.  If we interpolate
-    # along the row, aka: time based (axis=0), we assume that more often than not the missing
-    # value is relatively constant across time.
-    # TODO(dph): Explore limit_area, limit and limit_direction arguments to
-    if options['interpolate']:
-        logging.info('Interpolating the merged dataframe values.')
-        print('Interpolating the merged dataframe values.')
-        merge_df.interpolate(
-            method='linear', axis=0, inplace=True, limit_direction='both')
-
-    # TODO(dph): Turn this into an option --generate_stats
-    # Create a summary dataframes for both the time and day axes
-    #time_summary_df = pd.DataFrame()
-    #day_summary_df = pd.DataFrame()
-
-    # TODO(dph): This throws the warning "RuntimeWarning: All-NaN slice encountered overwrite_input=overwrite_input)"
-    #            Only does this when there are NaaN values.
-    #print('\nGenerating basic statistics along the columns axis.')
-    #time_summary_df = generate_stats_df(merge_df, 'columns')
-    #print('\nGenerating basic statistics along the index axis.')
-    #day_summary_df = generate_stats_df(merge_df, 'index')
-    #if 'steps' in options['analyze_type']:
-    #    day_summary_df['Total Steps'] = merge_df.sum(axis='index', skipna=True)
+        # TODO(dph): Turn this into an option --generate_stats
+        # Create a summary dataframes for both the time and day axes
+        #time_summary_df = pd.DataFrame()
+
+        #print('\nGenerating basic statistics along the columns axis.')
+        #time_summary_df = generate_stats_df(merge_df, 'columns')
+        if options['plot_stats'] and merge_df.shape[1] and not (cube_summary and resource == 'heartrate'):
+            print('\nGenerating basic statistics along the index axis for ' + resource + '.')
+            loaded_summary_df = generate_stats_df(merge_df, 'index')
+            loaded_summary_df['Total'] = merge_df.sum(axis='index', skipna=True)
+            if day_summaries[resource].empty:
+                day_summaries[resource] = loaded_summary_df
+            else:
+                day_summaries[resource] = pd.concat([day_summaries[resource], loaded_summary_df]).sort_index()
+
+    for resource, day_summary_df in day_summaries.items():
+        if not day_summary_df.empty:
+            day_summary_df.index = pd.to_datetime(day_summary_df.index)
 
     # if 'sleep' in options['analyze_type']:
         # Switch 0,1,2,3 for stages of sleep
 
+    # Line the resources up minute by minute for cross resource analysis.
+    joined_df = None
+    if not summary_only and len(merged) > 1:
+        joined_df = join_per_minute({resource: m[0] for resource, m in merged.items()}, frag_list)
+        logging.info('Joined ' + ', '.join(merged) + ' into ' + str(len(joined_df)) + ' minutes.')
+
     if options['plot_stats']:
-        # Generate some simple plots on the statistics
-        fig = plt.figure()
-        plt.style.use('seaborn-white')
-
-        # If we have a heartrate and steps, plot the steps below
-        # the heartbeat plot using the same x axis limits
-        ax = fig.gca()
-        ax.xaxis.set_major_locator(plt.MaxNLocator())
-        ax.xaxis.set_minor_locator(AutoMinorLocator())
-        ax.yaxis.set_major_locator(plt.MaxNLocator())
-        ax.yaxis.set_minor_locator(AutoMinorLocator())
-        ax.tick_params(axis='both', labelsize='small',
-                       labelrotation=0, length=10,
-                       direction='out', grid_alpha=0)
-        ax.set_xmargin(0.005)
-        ax.set_title('Fitbit Readings Over Time',
-                     pad=20, loc='center', fontsize=24)
-
-        if 'heartrate' in options['analyze_type']:
-            ax.set_xlabel('Date', labelpad=20, fontsize=14, color='blue')
-            ax.set_ylabel('Heartrate', labelpad=20, fontsize=14, color='blue')
-            min_y = day_summary_df['Min']
-            max_y = day_summary_df['Max']
-            median_y = day_summary_df['Median']
-            x = day_summary_df.index
-            ax.plot(x, min_y, 'b-', label='Min Heartrate')
-            ax.plot(x, max_y, 'r-', label='Max Heartrate')
-            ax.plot(x, median_y, 'g-', label='Median Heartrate')
-            day_summary_df.plot()
-
-        elif 'steps' in options['analyze_type']:
-            ax.set_xlabel('Date', labelpad=20, fontsize=14, color='blue')
-            ax.set_ylabel('Steps', labelpad=20, fontsize=14, color='blue')
-            min_y = day_summary_df['Total Steps']
-            x = day_summary_df.index
-            ax.bar(x, min_y, color='grey',
-                   orientation='vertical', label='Total Steps')
-
-        elif 'sleep' in options['analyze_type']:
-            ax.set_xlabel('Date', labelpad=20, fontsize=14, color='blue')
-            ax.set_ylabel('Sleep Stage', labelpad=20, fontsize=14, color='blue')
-            min_y = day_summary_df['Mean']
-            x = day_summary_df.index
-            ax.bar(x, min_y, color='grey',
-                   orientation='vertical', label='Sleep Stage')
-        # Finally show the plots/charts.  Only call this at the end
-        ax.legend(loc='upper center', frameon=True, ncol=3, fancybox=True)
-        plt.show()
+        # Generate some simple plots on the statistics, a figure per resource
+        # (and period), followed by the samples themselves with --plot_series.
+        figures = list()
+        for resource, day_summary_df in day_summaries.items():
+            if not day_summary_df.empty:
+                figures.extend(summary_figures(resource, day_summary_df, options['plot_period']))
+        if options['plot_series']:
+            for resource, (merge_df, _, _) in merged.items():
+                if merge_df.shape[1]:
+                    figures.extend(series_figures(resource, merge_df, options['plot_period']))
+        if options['plot_dir']:
+            written = render_figures(figures, options['plot_dir'], options['plot_format'], options['workers'])
+            msg = 'Rendered ' + str(len(written)) + ' plots to ' + options['plot_dir']
+            logging.info(msg)
+            print(msg)
+        elif figures:
+            show_figures(figures)
     #else:
         # Just print out a sample of the statistics dataframe
         #print(day_summary_df)
@@ -615,6 +865,8 @@ if __name__ == '__main__':
         #print(time_summary_df)
 
     # Do deeper statistical analysis
+    # import statsmodels.api as sm
+    # import statsmodels.formula.api as smf
     # print('Calculating seasonality of the day statistics dataset.')
     # Note:  All dates must be accounted for in the time series for this function to work.
     # decomposition = sm.tsa.seasonal_decompose(day_summary_df, model='addative')
@@ -623,14 +875,40 @@ if __name__ == '__main__':
     # decomposition = sm.tsa.seasonal_decompose(time_summary_df, model='addative')
     # decomposition.plot()
 
-    # To do a simple analysis, add the sleep data into the merged dataframe to see what type of sleep was occuring during the heartrate
+    # To do a simple analysis, match the sleep data against the heartrate to see what type of sleep was
+    # occuring during the heartrate.  Interpolated heartrate samples are left out.
+    sleep_hr_df = None
+    if not summary_only and 'sleep' in merged and 'heartrate' in merged:
+        sleep_hr_df = sleep_heartrate(merged['sleep'][0], merged['heartrate'][0], merged['heartrate'][1])
+        msg = 'Matched heartrate to the sleep stages of ' + \
+              str(sleep_hr_df.index.get_level_values('night').nunique()) + ' nights.'
+        logging.info(msg)
+        print(msg)
 
     # Retain summary files if requested
     if options['retain']:
         msg = 'Saving dataframe '
-        print(msg + 'merged dataframe.')
-        logging.info(msg + 'merged')
-        merge_df.to_csv('merged_df.csv')
+        for resource, (merge_df, interpolated_df, _) in merged.items():
+            # A single resource keeps the original merged_df.csv name.
+            if len(merged) == 1:
+                merged_name = 'merged_df.csv'
+            else:
+                merged_name = 'merged_df_' + resource + '.csv'
+            print(msg + resource + ' merged dataframe.')
+            logging.info(msg + 'merged ' + resource)
+            merge_df.to_csv(merged_name)
+            if interpolated_df is not None:
+                print(msg + 'interpolated sample mask.')
+                logging.info(msg + 'interpolated sample mask')
+                interpolated_df.to_csv('interpolated_mask.csv')
+        if joined_df is not None:
+            print(msg + 'joined per minute dataframe.')
+            logging.info(msg + 'joined per minute')
+            joined_df.to_csv('joined_df.csv')
+        if sleep_hr_df is not None:
+            print(msg + 'sleep stage heartrate dataframe.')
+            logging.info(msg + 'sleep stage heartrate')
+            sleep_hr_df.to_csv('sleep_heartrate.csv')
 
      #   print(msg + 'day summary dataframe.')
      #   logging.info(msg + 'day summary dataframe.')
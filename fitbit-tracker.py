@@ -22,6 +22,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
 import fitbit
 import inspect
 import argparse
@@ -30,12 +31,20 @@ import os
 import os.path
 import sys
 import pandas as pd
+import requests
 import logging
 import logging.handlers
 import io
+import time
 from tqdm import tqdm
 from os import path
-from datetime import datetime, time
+from fitbit_cube import HeartRateCube
+from fitbit_daystats import DaySketch, DayStatsTable
+from fitbit_fetch import CheckpointJournal, FetchEngine, FetchTask, RateLimiter, TokenManager, build_tasks, get_resources
+from fitbit_fetch import log_payload, set_payload_archive
+from fitbit_series import IntradaySeries, time_to_seconds
+from fitbit_storage import BACKENDS, CODECS, DailyTable, FileCatalog, JsonArchive, get_storage, group_archive_files, iter_archive_file
+from datetime import datetime
 from datetime import date
 from datetime import timedelta
 
@@ -44,7 +53,6 @@ __VERSION__ = 'fitbit-tracker ver 1-1'
 __LOG_NAME__ = 'fitbit-tracker.log'
 __TITLE__ = 'fitbit-tracker.py'
 __DEBUG__ = False
-CONFIG_FILE = ''
 
 def set_command_options():
     "Sets the command line arguments."
@@ -102,6 +110,76 @@ def set_command_options():
         '--json',
         help='Save original JSON data files.',
         action='store_true')
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='Number of concurrent requests to the Fitbit API, or processes for --replay. (default: %(default)s)',
+        action='store',
+        type=int,
+        dest='workers',
+        default=4)
+    parser.add_argument(
+        '--json_codec',
+        help='Compression used for the saved JSON data. (default: %(default)s)',
+        action='store',
+        type=str,
+        choices=sorted(CODECS),
+        dest='json_codec',
+        default='gzip')
+    parser.add_argument(
+        '--json_bundle',
+        help='Save JSON data as one file per day or one archive per resource per month. (default: %(default)s)',
+        action='store',
+        type=str,
+        choices=['day', 'month'],
+        dest='json_bundle',
+        default='day')
+    parser.add_argument(
+        '--payload_log',
+        help='Write the full API responses to this rotating log file.',
+        action='store',
+        type=str,
+        dest='payload_log')
+    parser.add_argument(
+        '--storage',
+        help='Format used to store the per-day data files. (default: %(default)s)',
+        action='store',
+        type=str,
+        choices=sorted(BACKENDS),
+        dest='storage',
+        default='csv')
+    parser.add_argument(
+        '--hr_cube',
+        help='Also keep the memory-mapped heart rate cube in the output directory up to date.',
+        action='store_true',
+        dest='hr_cube')
+    parser.add_argument(
+        '--day_stats',
+        help='Also keep the per-day statistics tables in the output directory up to date.',
+        action='store_true',
+        dest='day_stats')
+    parser.add_argument(
+        '--resume',
+        help='Skip days already recorded as fetched in the output directory journal and retry failed ones.',
+        action='store_true')
+    parser.add_argument(
+        '-i',
+        '--incremental',
+        help='Only fetch days whose files are missing or incomplete, topping up partial days.',
+        action='store_true')
+    parser.add_argument(
+        '--request_limit',
+        help='Number of Fitbit API requests allowed per hour. (default: %(default)s)',
+        action='store',
+        type=int,
+        dest='request_limit',
+        default=150)
+    parser.add_argument(
+        '--rate_state',
+        help='File used to remember API usage between runs. (default: fitbit-ratelimit.json next to the configuration file)',
+        action='store',
+        type=str,
+        dest='rate_state_file')
     group.add_argument(
         '-a',
         '--all',
@@ -110,7 +188,7 @@ def set_command_options():
     group.add_argument(
         '-t',
         '--type',
-        help='Collect only the type of data specified (heartrate, sleep, steps)',
+        help='Collect only the type of data specified (heartrate, sleep, steps, summary).  summary collects the daily totals with range requests',
         action='store',
         type=str,
         dest='collect_type')
@@ -134,6 +212,28 @@ def set_command_options():
         action='store',
         type=str,
         dest='date_to_collect')
+    group_2.add_argument(
+        '--daemon',
+        help='Run continuously, topping up today and finalizing yesterday on a schedule.',
+        action='store_true')
+    group_2.add_argument(
+        '--replay',
+        help='Rebuild the data files from the JSON archive in the output directory without calling the API.',
+        action='store_true')
+    parser.add_argument(
+        '--interval',
+        help='Minutes between top-ups of today in daemon mode. (default: %(default)s)',
+        action='store',
+        type=int,
+        dest='interval',
+        default=15)
+    parser.add_argument(
+        '--finalize_time',
+        help='Time of day (HH:MM) to finalize yesterday in daemon mode. (default: %(default)s)',
+        action='store',
+        type=str,
+        dest='finalize_time',
+        default='03:00')
 
     args = parser.parse_args()
     return (parser)
@@ -249,6 +349,10 @@ def get_command_options(parser):
             options['end_date'] = args.end_date
             logging.info('Start date: ' + args.start_date)
             logging.info('End date: ' + args.end_date)
+    elif args.daemon:
+        logging.info('Running as a daemon.')
+    elif args.replay:
+        logging.info('Replaying the JSON archive.')
     else:
         logging.error('Invalide collection days specified.  Both start and end dates need to be specified. Exiting.')
         print('Please specify collection days.')
@@ -263,28 +367,81 @@ def get_command_options(parser):
 
     if args.json:
         options['json']=True
+        try:
+            JsonArchive(args.output_dir, codec=args.json_codec, bundle=args.json_bundle)
+        except ImportError as err:
+            logging.error(str(err) + '  Exiting.')
+            print(str(err))
+            sys.exit(1)
     else:
         options['json']=False
+    options['json_codec'] = args.json_codec
+    options['json_bundle'] = args.json_bundle
+
+    if args.workers <= 0:
+        logging.error(str(args.workers) + ' is an illegal number of workers. Must be greater than zero.  Exiting')
+        print(str(args.workers) + ' is an illegal number of workers. Must be greater than zero.')
+        sys.exit(1)
+    else:
+        options['workers'] = args.workers
+
+    if args.request_limit <= 0:
+        logging.error(str(args.request_limit) + ' is an illegal request limit. Must be greater than zero.  Exiting')
+        print(str(args.request_limit) + ' is an illegal request limit. Must be greater than zero.')
+        sys.exit(1)
+    else:
+        options['request_limit'] = args.request_limit
+
+    try:
+        get_storage(args.storage, args.output_dir)
+        options['storage'] = args.storage
+    except ImportError as err:
+        logging.error(str(err) + '  Exiting.')
+        print(str(err))
+        sys.exit(1)
+
+    if args.resume:
+        options['resume'] = True
+    else:
+        options['resume'] = False
+
+    if args.payload_log:
+        options['payload_log'] = args.payload_log
+        set_payload_archive(args.payload_log)
+        logging.info('Writing API responses to ' + args.payload_log)
+
+    options['daemon'] = args.daemon
+    options['replay'] = args.replay
+    options['hr_cube'] = args.hr_cube
+    options['day_stats'] = args.day_stats
+    if args.daemon:
+        try:
+            datetime.strptime(args.finalize_time, '%H:%M')
+        except ValueError:
+            logging.error(str(args.finalize_time) + ' is an invalid finalize time.  Exiting.')
+            print(str(args.finalize_time) + ' is an invalid finalize time.  Use HH:MM.')
+            sys.exit(1)
+        if args.interval <= 0:
+            logging.error(str(args.interval) + ' is an illegal interval. Must be greater than zero.  Exiting')
+            print(str(args.interval) + ' is an illegal interval. Must be greater than zero.')
+            sys.exit(1)
+        options['interval'] = args.interval
+        options['finalize_time'] = args.finalize_time
+
+    if args.incremental:
+        options['incremental'] = True
+    else:
+        options['incremental'] = False
+
+    if args.rate_state_file:
+        options['rate_state_file'] = args.rate_state_file
+    else:
+        config_dir = os.path.dirname(os.path.abspath(options['config_file']))
+        options['rate_state_file'] = os.path.join(config_dir, 'fitbit-ratelimit.json')
 
     logging.info(json.dumps(options))
     return (options)
 
-def refresh_new_token(token):
-    """Called when the access token needs to be refreshed. """
-    new_access_token = token['access_token']
-    new_refresh_token = token['refresh_token']
-    new_expires_at = token['expires_at']
-    logging.info('Refreshing token.')
-    logging.info('New token will expire at: ' + str(datetime.fromtimestamp(new_expires_at)))
-
-    with open(CONFIG_FILE) as json_config_file:
-        data = json.load(json_config_file)
-    data['access_token'] = new_access_token
-    data['refresh_token'] = new_refresh_token
-    data['token_expires'] = new_expires_at
-    with open(CONFIG_FILE, 'w') as j_config_file:
-        json.dump(data, j_config_file, indent=4)
-
 def is_valid_date(date_to_check):
     """ Checks to see if the date is valid """
     year, month, day = date_to_check.split('-', 3)
@@ -294,83 +451,439 @@ def is_valid_date(date_to_check):
         return (False)
     return (True)
 
-def get_heartrate(oauth_client, start_date, time_interval, results_file, save_json):
+def make_fetchers(oauth_client, options, last_times=None):
+    """ Returns a dict mapping each resource to a function that fetches and stores one day.
+    Args:
+      oauth_client:  An OAuth2 client id.
+      options:       The command line options dict
+      last_times:    Optional dict of (date, resource) to the HH:MM:SS of the
+                     last stored sample.  Those days are topped up rather than
+                     fetched from midnight.
+    Returns:
+      A dict of resource name to a function taking a yyyy-mm-dd string.
+    """
+    storage = get_storage(options['storage'], options['output_dir'])
+    storage.attach_catalog()
+    if options['json']:
+        archive = JsonArchive(options['output_dir'], codec=options['json_codec'], bundle=options['json_bundle'])
+    else:
+        archive = None
+    if options.get('hr_cube'):
+        cube = HeartRateCube(options['output_dir'])
+    else:
+        cube = None
+    if options.get('day_stats'):
+        stats = DayStatsTable(storage)
+    else:
+        stats = None
+    if last_times is None:
+        last_times = dict()
+
+    def fetch_heartrate(date_str):
+        return (get_heartrate(oauth_client=oauth_client, start_date=date_str, time_interval='1sec',
+                              storage=storage, archive=archive, cube=cube, stats=stats,
+                              last_time=last_times.get((date_str, 'heartrate'))))
+
+    def fetch_steps(date_str):
+        return (get_steps(oauth_client=oauth_client, start_date=date_str, time_interval='1min',
+                          storage=storage, archive=archive, stats=stats,
+                          last_time=last_times.get((date_str, 'steps'))))
+
+    def fetch_sleep(date_str):
+        # get_sleep reports against the previous day, so hand it the following day.
+        next_day = datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=1)
+        return (get_sleep(oauth_client=oauth_client, start_date=next_day,
+                          storage=storage, archive=archive, stats=stats))
+
+    return ({'heartrate': fetch_heartrate, 'steps': fetch_steps, 'sleep': fetch_sleep})
+
+def select_incremental_tasks(tasks, storage, journal, today_str):
+    """ Drops the tasks whose files are complete and finds the partial days to top up.
+    Args:
+      tasks:       The list of FetchTasks requested
+      storage:     The storage backend holding the per-day files
+      journal:     CheckpointJournal holding the completeness markers
+      today_str:   Today as yyyy-mm-dd
+    Returns:
+      A tuple of the tasks still to fetch and a dict of (date, resource) to the
+      last stored sample time for the intraday files to top up.
+    """
+    remaining = list()
+    last_times = dict()
+    for task in tasks:
+        state, last_time = get_file_state(storage, task.date_str, task.resource, journal, today_str)
+        if state == 'complete':
+            continue
+        remaining.append(task)
+        if state == 'partial' and task.resource != 'sleep':
+            last_times[(task.date_str, task.resource)] = last_time
+    return (remaining, last_times)
+
+def collect_days(oauth_client, options, limiter, journal, date_list, resources=None,
+                 incremental=False, resume=False, progress=True):
+    """ Fetches the requested resources for a list of days.
+    Args:
+      oauth_client:  An OAuth2 client id.
+      options:       The command line options dict
+      limiter:       RateLimiter shared by every request
+      journal:       CheckpointJournal recording each outcome
+      date_list:     List of yyyy-mm-dd strings to collect
+      resources:     Optional list restricting the resources collected
+      incremental:   Skip complete files and top up partial ones
+      resume:        Skip pairs the journal records as fetched
+      progress:      Show a progress bar
+    Returns:
+      The number of requests made.
+    NB: Fitbit exceptions are passed on to the caller.
+    """
+    tasks = build_tasks(date_list, options['collect_type'])
+    if resources is not None:
+        tasks = [t for t in tasks if t.resource in resources]
+    if not tasks:
+        return (0)
+    if resume:
+        retry_count = len([t for t in journal.failed() if t in tasks])
+        requested_count = len(tasks)
+        tasks = journal.pending(tasks)
+        msg = 'Resuming: ' + str(requested_count - len(tasks)) + ' of ' + str(requested_count) + \
+              ' already fetched, retrying ' + str(retry_count) + ' failed.'
+        print(msg)
+        logging.info(msg)
+    last_times = dict()
+    if incremental:
+        today_str = datetime.today().strftime('%Y-%m-%d')
+        requested_count = len(tasks)
+        tasks, last_times = select_incremental_tasks(tasks, get_storage(options['storage'], options['output_dir']), journal, today_str)
+        msg = 'Incremental: ' + str(requested_count - len(tasks)) + ' of ' + str(requested_count) + \
+              ' already complete, topping up ' + str(len(last_times)) + ' partial days.'
+        if progress:
+            print(msg)
+        logging.info(msg)
+    engine = FetchEngine(make_fetchers(oauth_client, options, last_times), max_workers=options['workers'], limiter=limiter,
+                         retry_exceptions=(fitbit.exceptions.HTTPTooManyRequests,), journal=journal)
+    logging.info('Retrieving ' + str(len(tasks)) + ' resources using ' + str(options['workers']) + ' workers.')
+    if len(tasks) > limiter.tokens:
+        hours = (len(tasks) - limiter.tokens) / float(options['request_limit'])
+        msg = 'Request exceeds the hourly quota.  Expect about ' + '{:.1f}'.format(hours) + ' hours of pacing.'
+        print(msg)
+        logging.info(msg)
+
+    prog_bar = tqdm(total=len(tasks), desc='Retrieving data', ascii=True, disable=not progress)
+    for result in engine.run(tasks, progress=prog_bar):
+        pass
+    prog_bar.close()
+    return (len(tasks))
+
+# Daily summary column: time series resource.  The response holds the series
+# under the resource name with '/' replaced by '-'.
+SUMMARY_SERIES = {
+    'steps': 'activities/steps',
+    'calories': 'activities/calories',
+    'distance': 'activities/distance',
+    'minutes_asleep': 'sleep/minutesAsleep',
+    'efficiency': 'sleep/efficiency',
+    'resting_hr': 'activities/heart',
+}
+# Longest range requested in one call.  The heart rate series allows a year.
+SUMMARY_MAX_DAYS = 365
+
+def get_summary_series(oauth_client, resource, start_date_str, end_date_str):
+    """ Retrieves one daily time series for a range of days.
+    Args:
+      oauth_client:    An OAuth2 client id.
+      resource:        The time series resource, e.g. activities/steps
+      start_date_str:  First day of the range (yyyy-mm-dd)
+      end_date_str:    Last day of the range (yyyy-mm-dd), inclusive
+    Returns:
+      A dict of yyyy-mm-dd to the value for the day.  Days without a value
+      (e.g. no resting heart rate) are left out.
+    """
+    series = oauth_client.time_series(resource, base_date=start_date_str, end_date=end_date_str)
+    log_payload(resource, start_date_str, series)
+    values = dict()
+    for entry in series[resource.replace('/', '-')]:
+        value = entry['value']
+        if isinstance(value, dict):
+            value = value.get('restingHeartRate')
+        if value is None or value == '':
+            continue
+        values[entry['dateTime']] = float(value)
+    return (values)
+
+def collect_summary(oauth_client, options, limiter, date_list, progress=True):
+    """ Fetches the daily summary metrics for a list of days into the daily table.
+
+    Rather than one request per day, each metric is requested for up to
+    SUMMARY_MAX_DAYS days at a time, so a year of daily values costs one call
+    per metric.  The days are stored in the daily_summary table of the
+    selected storage backend, replacing any earlier values for the same days.
+    Args:
+      oauth_client:  An OAuth2 client id.
+      options:       The command line options dict
+      limiter:       RateLimiter shared by every request
+      date_list:     Sorted list of consecutive yyyy-mm-dd strings to collect
+      progress:      Show a progress bar
+    Returns:
+      The number of requests made.
+    NB: Fitbit exceptions are passed on to the caller.
+    """
+    if not date_list:
+        return (0)
+    # The chunks are keyed by their first day, which the FetchTasks carry.
+    chunks = dict()
+    for i in range(0, len(date_list), SUMMARY_MAX_DAYS):
+        chunk = date_list[i:i + SUMMARY_MAX_DAYS]
+        chunks[chunk[0]] = chunk[-1]
+
+    def make_fetcher(resource):
+        def fetch(chunk_start):
+            return (get_summary_series(oauth_client, resource, chunk_start, chunks[chunk_start]))
+        return (fetch)
+
+    fetchers = {column: make_fetcher(resource) for column, resource in SUMMARY_SERIES.items()}
+    tasks = [FetchTask(chunk_start, column) for chunk_start in chunks for column in SUMMARY_SERIES]
+    engine = FetchEngine(fetchers, max_workers=options['workers'], limiter=limiter,
+                         retry_exceptions=(fitbit.exceptions.HTTPTooManyRequests,))
+    logging.info('Retrieving the daily summary for ' + str(len(date_list)) + ' days in ' + str(len(tasks)) + ' requests.')
+
+    summary = pd.DataFrame(index=pd.Index(date_list, name='date'), columns=list(SUMMARY_SERIES), dtype='float64')
+    prog_bar = tqdm(total=len(tasks), desc='Retrieving summary', ascii=True, disable=not progress)
+    for result in engine.run(tasks, progress=prog_bar):
+        values = pd.Series(result.value, dtype='float64')
+        summary.loc[values.index.intersection(summary.index), result.task.resource] = values
+    prog_bar.close()
+
+    table = DailyTable(get_storage(options['storage'], options['output_dir']), 'daily_summary')
+    results_file = table.update(summary.dropna(how='all'))
+    logging.info('Stored the daily summary in ' + results_file)
+    return (len(tasks))
+
+def get_next_finalize(now, finalize_time):
+    """ Returns the next datetime at which the previous day is finalized. """
+    hour, minute = finalize_time.split(':')
+    next_run = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    if next_run <= now:
+        next_run = next_run + timedelta(days=1)
+    return (next_run)
+
+def finalize_day(oauth_client, options, limiter, journal, date_str):
+    """ Completes the files of a day that has ended, and its summary if collected. """
+    collect_days(oauth_client, options, limiter, journal, [date_str], incremental=True, progress=False)
+    if 'summary' in options['collect_type']:
+        collect_summary(oauth_client, options, limiter, [date_str], progress=False)
+
+def run_daemon_step(description, func, *args, **kwargs):
+    """ Runs one step of the daemon.
+    Returns:
+      True if the step completed, False if it failed with an API or
+      connection error that is retried later.  Authorization errors exit.
+    """
+    logging.info(description)
+    try:
+        func(*args, **kwargs)
+        return (True)
+    except fitbit.exceptions.HTTPUnauthorized:
+        print('Please provide latest refresh and access tokens for oauth2. Exiting program.')
+        logging.error('HTTPUnauthorized: Please provide latest refresh and access tokens for oauth2. Exiting program.')
+        sys.exit(1)
+    except (fitbit.exceptions.HTTPException, fitbit.exceptions.Timeout,
+            requests.exceptions.RequestException) as err:
+        logging.error(description + ' failed.  ' + type(err).__name__ + ': ' + str(err) + '.  Retrying later.')
+        return (False)
+
+def run_daemon(oauth_client, options, limiter, journal):
+    """ Keeps collecting data until interrupted.
+
+    Today's intraday files are topped up every interval minutes and once a
+    night, at finalize_time, yesterday's files (including sleep_day_<yesterday>,
+    the sleep that ended yesterday morning) are completed so the journal marks
+    them final.  The same clients and rate limiter are used for every
+    iteration, so the hourly quota is respected across iterations.  API and
+    connection errors are logged and the failed step is retried an interval
+    later, without holding up the other step.  Authorization errors stop the
+    daemon.
+    """
+    interval = timedelta(minutes=options['interval'])
+    now = datetime.now()
+    next_topup = now
+    # Finalize once at start up in case the daemon was down overnight.
+    next_finalize = now
+    msg = 'Starting daemon.  Top-up every ' + str(options['interval']) + ' minutes, finalizing at ' + options['finalize_time']
+    print(msg)
+    logging.info(msg)
+
+    while True:
+        now = datetime.now()
+        today_str = now.strftime('%Y-%m-%d')
+        if now >= next_finalize:
+            yesterday_str = (now - timedelta(days=1)).strftime('%Y-%m-%d')
+            if run_daemon_step('Finalizing ' + yesterday_str, finalize_day,
+                               oauth_client, options, limiter, journal, yesterday_str):
+                next_finalize = get_next_finalize(now, options['finalize_time'])
+            else:
+                # Back off rather than retrying a failing day in a tight loop.
+                next_finalize = now + interval
+        if now >= next_topup:
+            run_daemon_step('Topping up ' + today_str, collect_days, oauth_client, options, limiter, journal,
+                            [today_str], resources=('heartrate', 'steps'), incremental=True, progress=False)
+            next_topup = now + interval
+
+        wake = min(next_topup, next_finalize)
+        logging.info('Next top-up at ' + next_topup.strftime('%Y-%m-%d %H:%M:%S') +
+                     ', next finalization at ' + next_finalize.strftime('%Y-%m-%d %H:%M:%S'))
+        try:
+            time.sleep(max(0.0, (wake - datetime.now()).total_seconds()))
+        except KeyboardInterrupt:
+            logging.info('Daemon stopped.')
+            print('Daemon stopped.')
+            return
+
+def get_start_time(last_time):
+    """ Returns the HH:MM start time to request given the last stored sample time.
+    The API only accepts minutes, so the minute containing the last sample is
+    requested again and the overlap is dropped by store_intraday.
+    """
+    if last_time is None:
+        return ('00:00')
+    return (last_time[:5])
+
+def store_intraday(series, storage, last_time):
+    """ Writes an IntradaySeries to its per-day file.
+    With last_time the samples up to and including last_time are dropped and
+    the rest are appended to the existing file, otherwise the file is rewritten.
+    """
+    if last_time is not None:
+        series = series.after(time_to_seconds(last_time))
+    results_file = storage.write_day(series.resource, series.date_str, series.to_frame(), append=last_time is not None)
+    if last_time is not None:
+        logging.info('Appended ' + str(len(series)) + ' samples after ' + last_time + ' to ' + results_file)
+    return (series)
+
+def get_file_state(storage, date_str, resource, journal, today_str):
+    """ Inspects an existing per-day file to decide what still needs fetching.
+    Args:
+      storage:       The storage backend holding the per-day files
+      date_str:      The yyyy-mm-dd day the file holds
+      resource:      heartrate, steps or sleep
+      journal:       CheckpointJournal holding the completeness markers
+      today_str:     Today as yyyy-mm-dd
+    Returns:
+      A tuple of (state, last_time) where state is 'missing', 'partial' or
+      'complete' and last_time is the HH:MM:SS of the last stored sample.
+    """
+    rows, last_time = storage.day_info(resource, date_str)
+    if rows == 0:
+        return ('missing', None)
+    if date_str >= today_str:
+        return ('partial', last_time)
+    if resource == 'sleep' or journal.is_final(FetchTask(date_str, resource)):
+        return ('complete', last_time)
+    # Files written before the journal existed are complete if they reach the end of the day.
+    if last_time >= '23:59:00':
+        return ('complete', last_time)
+    return ('partial', last_time)
+
+def get_heartrate(oauth_client, start_date, time_interval, storage, archive, last_time=None, cube=None, stats=None):
     """ Retrieve the intraday heartrate data and store to a file.
     Args:
       oauth_client:  An OAuth2 client id.
       start_date:    Collect starting at this date
       time_interval: Time ganualarity to collect. See fitbit documentation
-      results_file:  The name of the file to store results in
-      save_json:     Generate json file
+      storage:       The storage backend to store results in
+      archive:       JsonArchive to save the raw response in, or None
+      last_time:     If given (HH:MM:SS), only samples after this time are
+                     requested and they are appended to the existing file.
+      cube:          HeartRateCube to store the samples in as well, or None
+      stats:         DayStatsTable to summarize the day in, or None
     Returns:
-      A dataframe with the time and values.
+      An IntradaySeries with the seconds of day and values.
     """
     hr = oauth_client.intraday_time_series(
         resource='activities/heart',
         base_date=start_date,
         detail_level=time_interval,
-        start_time='00:00',
+        start_time=get_start_time(last_time),
         end_time='23:59')
-    logging.debug(json.dumps(hr, indent=2))
+    log_payload('heartrate', start_date, hr)
+
+    series = normalize_heartrate(hr, start_date, storage, last_time, cube, stats)
+    if archive is not None and len(series) > 0:
+        archive.write('heartrate', start_date, hr, last_time)
+    return (series)
 
+def normalize_heartrate(hr, start_date, storage, last_time=None, cube=None, stats=None):
+    """ Converts an intraday heartrate response into an IntradaySeries and stores it.
+    Returns the series, or an empty tuple if the response holds no data.
+    """
     if hr['activities-heart'][0]['value'] != 0:
-        df = pd.json_normalize(hr['activities-heart-intraday'], record_path=['dataset'], sep='_')
-        df.loc[:, 'time'] = pd.to_datetime((start_date)+' '+ (df.time.astype(str)))
-        df.to_csv(results_file, header=True, index=False)
-        if save_json:
-            with open(results_file.replace('.csv', '.json'), 'w') as json_file:
-                json.dump(hr, json_file)
-        return (df)
+        series = IntradaySeries.from_dataset(start_date, 'heartrate', hr['activities-heart-intraday']['dataset'])
+        series = store_intraday(series, storage, last_time)
+        if cube is not None:
+            cube.write_series(series, append=last_time is not None, storage=storage)
+        if stats is not None:
+            stats.record(series, append=last_time is not None)
+        return (series)
 
     else:
         logging.info("No heartrate data for " + str(start_date))
         return ()
 
-def get_steps(oauth_client, start_date, time_interval, results_file, save_json):
+def get_steps(oauth_client, start_date, time_interval, storage, archive, last_time=None, stats=None):
     """Retrieve the step count for the day at the specified interval, store
        data in a file and returns the data in a panda dataframe.
     Args:
       oauth_client:  An OAuth2 client id.
       start_date:    Collect starting at this date
       time_interval: Time ganualarity to collect. See fitbit documentation
-      results_file:  The name of the file to store results in
-      save_json:     Flag to generate json file
+      storage:       The storage backend to store results in
+      archive:       JsonArchive to save the raw response in, or None
+      last_time:     If given (HH:MM:SS), only samples after this time are
+                     requested and they are appended to the existing file.
+      stats:         DayStatsTable to summarize the day in, or None
     Returns:
-      A dataframe with the time and values.
+      An IntradaySeries with the seconds of day and values.
       NB: 2 files are stored each time.
     """
     steps = oauth_client.intraday_time_series(
         resource='activities/steps',
         base_date=start_date,
-        start_time='00:00',
+        start_time=get_start_time(last_time),
         end_time='23:59',
         detail_level=time_interval)
-    logging.debug(json.dumps(steps, indent=2))
+    log_payload('steps', start_date, steps)
+
+    series = normalize_steps(steps, start_date, storage, last_time, stats)
+    if archive is not None and len(series) > 0:
+        archive.write('steps', start_date, steps, last_time)
+    return (series)
 
+def normalize_steps(steps, start_date, storage, last_time=None, stats=None):
+    """ Converts an intraday steps response into an IntradaySeries and stores it.
+    Returns the series, or an empty tuple if the response holds no data.
+    """
     if steps['activities-steps'][0]['value'] != 0:
-        df = pd.json_normalize(steps['activities-steps-intraday'], record_path=['dataset'], sep='_')
-        df.loc[:, 'time'] = pd.to_datetime((start_date)+' '+ (df.time.astype(str)))
-        df.to_csv(results_file, header=True, index=False)
-        if save_json:
-            with open(results_file.replace('.csv', '.json'), 'w') as json_file:
-                json.dump(steps, json_file)
-        return (df)
+        series = IntradaySeries.from_dataset(start_date, 'steps', steps['activities-steps-intraday']['dataset'])
+        series = store_intraday(series, storage, last_time)
+        if stats is not None:
+            stats.record(series, append=last_time is not None)
+        return (series)
 
     else:
         logging.info("No step data for " + str(start_date))
         return ()
 
-def get_sleep(oauth_client, start_date, results_file, save_json):
+def get_sleep(oauth_client, start_date, storage, archive, stats=None):
     """ Retrieve the sleep data for the day, store in datafile and return the dataframe.
  
       :param oauth_client:     An OAuth2 client id.
       :param start_date:       Collect starting at this date
       :param time_interval:    Time ganualarity to collect. See fitbit documentation
-      :param results_file:     The name of the file to store results in
-      :param save_json:        Boolean to save json files as well
+      :param storage:          The storage backend to store results in
+      :param archive:          JsonArchive to save the raw response in, or None
+      :param stats:            DayStatsTable to summarize the day in, or None
       :param api_ver:          The API version to use (1 or 1.2)
     
-      :return df:A dataframe with the time and values.
+      :return series:An IntradaySeries with the seconds of day and values.
     
     NB: Sleep is actually reported for the next day since it starts
         prior to midnight.  To correct, subtract one day from the date
@@ -392,20 +905,104 @@ def get_sleep(oauth_client, start_date, results_file, save_json):
     """
     sub_day = timedelta(1)
     start_date = start_date - sub_day
-    sleep = authd_client2.get_sleep(start_date)
-    logging.debug(json.dumps(sleep, indent=2))
-
+    start_date_str = start_date.strftime('%Y-%m-%d')
+    sleep = oauth_client.get_sleep(start_date)
+    log_payload('sleep', start_date_str, sleep)
+
+    series = normalize_sleep(sleep, start_date_str, storage, stats=stats)
+    if archive is not None and len(series) > 0:
+        archive.write('sleep', start_date_str, sleep)
+    return (series)
+
+def normalize_sleep(sleep, start_date_str, storage, last_time=None, stats=None):
+    """ Converts a sleep response into an IntradaySeries and stores it.
+    start_date_str is the day the sleep is reported against.  last_time is
+    accepted for symmetry with the intraday resources and ignored, since
+    sleep is always fetched whole.  Returns the series, or an empty tuple
+    if the response holds no data.
+    """
     if sleep['summary']['totalMinutesAsleep'] != 0:
-        df = pd.json_normalize(sleep['sleep'], record_path=['minuteData'], sep='_')
-        df.loc[:, 'dateTime'] = pd.to_datetime((str(start_date) +' '+ df.dateTime))
-        df.to_csv(results_file, header=True, index=False)
-        if save_json:
-            with open(results_file.replace('.csv', '.json'), 'w') as json_file:
-                json.dump(sleep, json_file)
-        return (df)
+        # Every sleep period (main sleep and naps) goes into the one day file.
+        minute_data = [minute for period in sleep['sleep'] for minute in period['minuteData']]
+        series = IntradaySeries.from_dataset(start_date_str, 'sleep', minute_data, time_key='dateTime')
+        storage.write_day('sleep', start_date_str, series.to_frame('dateTime'))
+        if stats is not None:
+            stats.record(series)
+        return (series)
     else:
-        logging.info("No sleep data for " + str(start_date))
+        logging.info("No sleep data for " + str(start_date_str))
         return()
+
+NORMALIZERS = {'heartrate': normalize_heartrate, 'steps': normalize_steps, 'sleep': normalize_sleep}
+
+def replay_files(file_names, storage_name, output_dir, resources):
+    """ Rebuilds the data files from a group of archive files, in order.
+    Runs in a worker process, so it opens its own storage backend and returns
+    the number of responses replayed and a dict of (resource, date) to the
+    DaySketch of each day rebuilt.  The sketches are small and are written to
+    the day stats tables by the parent, so the workers never share a table.
+    The catalog is not attached here either, the parent rescans it once the
+    workers are done.
+    """
+    storage = get_storage(storage_name, output_dir)
+    count = 0
+    sketches = dict()
+    for file_name in file_names:
+        for resource, date_str, last_time, payload in iter_archive_file(file_name):
+            if resource not in resources:
+                continue
+            series = NORMALIZERS[resource](payload, date_str, storage, last_time)
+            if len(series) > 0:
+                # A full day starts a new sketch, its top-ups add the samples appended.
+                if last_time is None or (resource, date_str) not in sketches:
+                    sketches[(resource, date_str)] = DaySketch()
+                sketches[(resource, date_str)].update_series(series)
+            count += 1
+    return (count, sketches)
+
+def replay_archive(options):
+    """ Rebuilds the per-day data files from the saved JSON responses.
+
+    No API calls are made.  The archive in the output directory is split into
+    groups (one day with its top-ups, or one monthly bundle) that are
+    normalized in parallel worker processes, using the same code as a live
+    fetch, and written with the selected storage backend.
+    Args:
+      options:     The command line options dict
+    Returns:
+      The number of responses replayed.
+    """
+    resources = [r for r in get_resources(options['collect_type']) if r in NORMALIZERS]
+    groups = group_archive_files(options['output_dir'])
+    msg = 'Replaying ' + str(len(groups)) + ' archive groups using ' + str(options['workers']) + ' processes.'
+    print(msg)
+    logging.info(msg)
+    count = 0
+    sketches = {resource: dict() for resource in resources}
+    prog_bar = tqdm(total=len(groups), desc='Replaying data', ascii=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options['workers']) as executor:
+        futures = [executor.submit(replay_files, group, options['storage'], options['output_dir'], resources)
+                   for group in groups]
+        for future in concurrent.futures.as_completed(futures):
+            group_count, group_sketches = future.result()
+            count += group_count
+            for (resource, date_str), sketch in group_sketches.items():
+                sketches[resource][date_str] = sketch
+            prog_bar.update(1)
+    prog_bar.close()
+    logging.info('Replayed ' + str(count) + ' responses.')
+    # The catalog file is not safe to write from several processes, so it is
+    # rebuilt from the directory once by the parent.
+    FileCatalog(get_storage(options['storage'], options['output_dir'])).scan()
+    if options['day_stats']:
+        stats = DayStatsTable(get_storage(options['storage'], options['output_dir']))
+        for resource in resources:
+            stats.update(resource, sketches[resource])
+    if options['hr_cube'] and 'heartrate' in resources:
+        # The workers only write the day files, the cube is rebuilt from them here.
+        HeartRateCube(options['output_dir']).update_from_storage(get_storage(options['storage'], options['output_dir']),
+                                                                 rebuild=True)
+    return (count)
 #
 #
 
@@ -431,46 +1028,46 @@ if __name__ == '__main__':
 
     parser = set_command_options()
     options = get_command_options(parser)
-    CONFIG_FILE = options['config_file']
 
-    with open(options['config_file']) as json_config_file:
-        data = json.load(json_config_file)
+    if options['replay']:
+        replay_archive(options)
+        sys.exit(0)
+
+    token_manager = TokenManager(options['config_file'])
 
-    if data['access_token'] == '':
+    if token_manager.access_token == '':
         print('No access token found.  Please generate and place in the configuration file.')
         logging.error('No access token found.  Exiting.')
         sys.exit(1)
 
     # Connect to the fitbit server using oauth2 See the page https://dev.fitbit.com/build/reference/web-api/oauth2/
+    # A single client and HTTP session is shared by every worker thread.  Refreshed
+    # tokens are kept in memory and only written back when they change.
     try:
-        authd_client = fitbit.Fitbit(data['client_id'], data['client_secret'],access_token=data['access_token'])
-        authd_client2 = fitbit.Fitbit(data['client_id'],data['client_secret'],oauth2=True,access_token=data['access_token'],
-                                      refresh_token=data['refresh_token'],refresh_cb=refresh_new_token)
+        authd_client = token_manager.create_client(pool_size=options['workers'])
 
-    except authd_client.exceptions.HTTPUnauthorized:
+    except fitbit.exceptions.HTTPUnauthorized:
         print('Please provide latest refresh and access tokens for oauth2. Exiting program.')
         logging.error('HTTPUnauthorized: Please provide latest refresh and access tokens for oauth2. Exiting program.')
         sys.exit(1)
 
-    # Note that that there is a limit of 150 api requests per hour. If the
-    # requested number of days will exceed that, message back to the caller and exit.
-    # TODO (dph): This should be placed in a sleep or loop.  Maybe an option.
-    request_limit = 150
-    num_types = 0
-    if 'heartrate' in options['collect_type']:  num_types += 1
-    if 'sleep' in options['collect_type']:      num_types += 1
-    if 'steps' in options['collect_type']:      num_types += 1
-    if num_types > 0 :
-        max_days = int(request_limit / num_types)
-    else:
-        max_days = 150
-    logging.info('Max days: ' + str(max_days))
+    # Note that that there is a limit of 150 api requests per hour.  Requests are
+    # paced by a token bucket that remembers calls made by earlier runs and reads
+    # the quota headers returned by Fitbit, so long ranges sleep until the window
+    # resets instead of exiting.
+    limiter = RateLimiter(capacity=options['request_limit'], state_file=options['rate_state_file'])
+    limiter.attach(authd_client.client.session)
+    logging.info('Requests available this hour: ' + str(int(limiter.tokens)))
+    journal = CheckpointJournal(options['output_dir'])
+
+    if options['daemon']:
+        run_daemon(authd_client, options, limiter, journal)
+        sys.exit(0)
+
     number_of_days_requested_int = 1
 
     # Get the start date and number of days to requested.
     if 'end_date' in options and 'start_date' in options:
-        # Ensure it does not exceed the api limit/hr 
-        # Note that this assumes there have been no other api requests during the hour.
         start_date = datetime.strptime(options['start_date'], '%Y-%m-%d')
         end_date = datetime.strptime(options['end_date'], '%Y-%m-%d')
         number_of_days_requested = end_date - start_date
@@ -480,10 +1077,6 @@ if __name__ == '__main__':
         logging.info('Days requested vale: ' + str(number_of_days_requested))
         logging.info('Number of interger days requested: ' + str(number_of_days_requested_int))
 
-        if number_of_days_requested_int > max_days:
-            logging.error('Requested days exceed number calls per hour.  Exiting')
-            sys.exit(1)
-
     elif 'number_of_days' in options:
         today = datetime.today()
         start_date = today - timedelta(days=options['number_of_days'])
@@ -500,73 +1093,64 @@ if __name__ == '__main__':
         sys.exit(1)
 
     #
-    # Main loop to iterrate through the days.  
+    # Fetch every day/resource pair concurrently.  Each fetch function writes
+    # its own file, so results land on disk as soon as each request completes.
     #
-    for d in tqdm(range(0, number_of_days_requested_int),desc='Retrieving data',ascii=True):
-        start_date_str = str(start_date.strftime('%Y-%m-%d'))
-        start_date = start_date + timedelta(days=1)
-
-        try:
-            tmp = 'hr_intraday_' + start_date_str + '.csv'
-            heartrate_file = os.path.join (options['output_dir'], tmp)
-            tmp = 'steps_intraday_' + start_date_str + '.csv'
-            steps_file = os.path.join(options['output_dir'], tmp)
-            tmp = 'sleep_day_' + start_date_str + '.csv'
-            sleep_file = os.path.join(options['output_dir'], tmp)
-
-            if 'daily' in options['collect_type']:
-                heartrate_df = get_heartrate(oauth_client=authd_client2, start_date=start_date_str, time_interval='1sec', results_file=heartrate_file, save_json=options['json'])
-                steps_df = get_steps(oauth_client=authd_client2, start_date=start_date_str, time_interval='1min', results_file=steps_file, save_json=options['json'])
-                sleep_df = get_sleep(oauth_client=authd_client2, start_date=start_date, results_file=sleep_file, save_json=options['json'])
-            elif 'heartrate' in options['collect_type']:
-                heartrate_df = get_heartrate(oauth_client=authd_client2, start_date=start_date_str, time_interval='1sec', results_file=heartrate_file, save_json=options['json'])
-            elif 'steps' in options['collect_type']:
-                steps_df = get_steps(oauth_client=authd_client2, start_date=start_date_str, time_interval='1min', results_file=steps_file, save_json=options['json'])
-            elif 'sleep' in options['collect_type']:
-                sleep_df = get_sleep(oauth_client=authd_client2, start_date=start_date, results_file=sleep_file, save_json=options['json'])
-
-        # Try and recover from exceptions and if not, gracefully report and exit.
-        except fitbit.exceptions.HTTPBadRequest:
-            # Response code = 400.
-            print('An unhandled exception.  Exiting program.')
-            logging.error('HTTPBadRequest: An unhandled exception. Exiting program.')
-            sys.exit(1)
+    date_list = list()
+    for d in range(0, number_of_days_requested_int):
+        date_list.append(str((start_date + timedelta(days=d)).strftime('%Y-%m-%d')))
+    start_date_str = str(start_date.strftime('%Y-%m-%d'))
+    try:
+        if 'summary' in options['collect_type']:
+            collect_summary(authd_client, options, limiter, date_list)
+        collect_days(authd_client, options, limiter, journal, date_list,
+                     incremental=options['incremental'], resume=options['resume'])
+
+    # Try and recover from exceptions and if not, gracefully report and exit.
+    except fitbit.exceptions.HTTPBadRequest:
+        # Response code = 400.
+        print('An unhandled exception.  Exiting program.')
+        logging.error('HTTPBadRequest: An unhandled exception. Exiting program.')
+        sys.exit(1)
 
-        except fitbit.exceptions.HTTPUnauthorized:
-            # Response code = 401, the token has expired, exit for now.  We should not get here.
-            print('Please provide latest refresh and access tokens for oauth2. Exiting program.')
-            logging.error('HTTPUnauthorized: Please provide latest refresh and access tokens for oauth2. Exiting program.')
-            sys.exit(1)
+    except fitbit.exceptions.HTTPUnauthorized:
+        # Response code = 401, the token has expired, exit for now.  We should not get here.
+        print('Please provide latest refresh and access tokens for oauth2. Exiting program.')
+        logging.error('HTTPUnauthorized: Please provide latest refresh and access tokens for oauth2. Exiting program.')
+        sys.exit(1)
 
-        except fitbit.exceptions.HTTPForbidden:
-            # Response code = 403.
-            print('You are not allowed to excute the function requested.  Exiting program.')
-            logging.error('HTTPForbidden: You are not allowed to excute the function requested.  Exiting program.')
-            sys.exit(1)
+    except fitbit.exceptions.HTTPForbidden:
+        # Response code = 403.
+        print('You are not allowed to excute the function requested.  Exiting program.')
+        logging.error('HTTPForbidden: You are not allowed to excute the function requested.  Exiting program.')
+        sys.exit(1)
 
-        except fitbit.exceptions.HTTPNotFound:
-            #  Response code = 404.
-            print('Requested function or data not found.  Exiting program.')
-            logging.error('HTTPNotFound: Requested function or data not found.  Exiting program.')
-            sys.exit(1)
+    except fitbit.exceptions.HTTPNotFound:
+        #  Response code = 404.
+        print('Requested function or data not found.  Exiting program.')
+        logging.error('HTTPNotFound: Requested function or data not found.  Exiting program.')
+        sys.exit(1)
 
-        except fitbit.exceptions.HTTPConflict:
-            #  Response code = 409.
-            print('Conflict when creating resources.  Exiting program.')
-            logging.error('HTTPConflict: Conflict when creating resources.  Exiting program.')
-            sys.exit(1)
+    except fitbit.exceptions.HTTPConflict:
+        #  Response code = 409.
+        print('Conflict when creating resources.  Exiting program.')
+        logging.error('HTTPConflict: Conflict when creating resources.  Exiting program.')
+        sys.exit(1)
 
-        except fitbit.exceptions.HTTPTooManyRequests:
-            #  Response code = 429.
-            print('Rate limit exceeded. Rerun program after 1 hour. Exiting program.')
-            print('Stopped at: ' + start_date_str)
-            logging.error('HTTPTooManyRequests: Rate limit exceeded. Rerun program after 1 hour. Exiting program.')
-            logging.info('Stopped at: ' + start_date_str)
-            sys.exit(1)
+    except fitbit.exceptions.HTTPTooManyRequests as err:
+        #  Response code = 429.
+        start_date_str = err.fetch_task.date_str
+        # Only reached once the retries after waiting for the quota reset are used up.
+        print('Rate limit exceeded. Rerun program after 1 hour. Exiting program.')
+        print('Stopped at: ' + start_date_str + '.  Rerun with --resume to continue.')
+        logging.error('HTTPTooManyRequests: Rate limit exceeded. Rerun program after 1 hour. Exiting program.')
+        logging.info('Stopped at: ' + start_date_str)
+        sys.exit(1)
 
-        except fitbit.exceptions.HTTPServerError:
-            # Response code = 500.
-            print('A generic error was returned.  Exiting program.')
-            logging.error('HTTPServerError: A generic error was returned.  Exiting program.')
-            sys.exit(1)
+    except fitbit.exceptions.HTTPServerError:
+        # Response code = 500.
+        print('A generic error was returned.  Exiting program.')
+        print('Rerun with --resume to retry the failed days.')
+        logging.error('HTTPServerError: A generic error was returned.  Exiting program.')
+        sys.exit(1)
 
@@ -0,0 +1,251 @@
+# /usr/bin/python3
+# -*- coding: utf-8 -*-
+# MIT License
+
+# Copyright (c) 2019 David Hunter
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+""" A persistent, memory-mapped days x seconds cube of heart rate samples.
+
+Every day of 1 second heart rate occupies one 86,400 byte row of a flat uint8
+file, with 0 marking a second without a sample (a heart rate of 0 bpm is never
+recorded).  A small json sidecar maps each yyyy-mm-dd date to its row, so rows
+are added in whatever order the days are collected:
+
+  results/hr_cube.u8           rows x 86400 uint8 samples
+  results/hr_cube_index.json   {"seconds": 86400, "rows": {"2019-01-01": 0, ...}}
+
+A year is 31.5 MB.  Opening the cube only maps the file, so selecting a range of
+days costs nothing until the rows are touched, and the statistics are computed
+a block of rows or seconds at a time so memory use stays bounded over years of
+data.  fitbit-tracker.py keeps the cube up to date as it stores heart rate
+(--hr_cube) and an existing directory of day files can be loaded with:
+
+  python fitbit_cube.py results
+
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+import numpy as numpy
+import pandas as pd
+from tqdm import tqdm
+
+from fitbit_series import IntradaySeries
+from fitbit_stats import STATS_COLUMNS, stats_frame
+from fitbit_storage import BACKENDS, get_storage
+
+SECONDS_PER_DAY = 86400
+MISSING = 0
+
+
+class HeartRateCube(object):
+    """ Memory-mapped days x seconds heart rate array with a date to row sidecar.
+    Args:
+      output_dir:  Directory holding the cube files
+      name:        Base name of the cube files
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, output_dir, name='hr_cube'):
+        self.output_dir = output_dir
+        self.data_file = os.path.join(output_dir, name + '.u8')
+        self.index_file = os.path.join(output_dir, name + '_index.json')
+        self.rows = dict()
+        self.load()
+
+    def load(self):
+        """ Reads the date to row sidecar. """
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as index_file:
+                self.rows = json.load(index_file)['rows']
+        return (self.rows)
+
+    def _save_index(self):
+        fd, tmp_name = tempfile.mkstemp(dir=self.output_dir, suffix='.json.tmp')
+        with os.fdopen(fd, 'w') as index_file:
+            json.dump({'seconds': SECONDS_PER_DAY, 'rows': self.rows}, index_file, sort_keys=True)
+        os.replace(tmp_name, self.index_file)
+
+    def __len__(self):
+        return (len(self.rows))
+
+    def __contains__(self, date_str):
+        return (date_str in self.rows)
+
+    def dates(self):
+        """ Returns the sorted list of dates held in the cube. """
+        return (sorted(self.rows))
+
+    def array(self):
+        """ Returns the whole cube as a read only rows x seconds memmap. """
+        if not self.rows:
+            return (numpy.zeros((0, SECONDS_PER_DAY), dtype='uint8'))
+        return (numpy.memmap(self.data_file, dtype='uint8', mode='r', shape=(len(self.rows), SECONDS_PER_DAY)))
+
+    def write_day(self, date_str, seconds, values, append=False):
+        """ Stores the samples of a day.
+        Args:
+          date_str:  The yyyy-mm-dd day
+          seconds:   Seconds of day of the samples
+          values:    The samples, already narrowed to uint8
+          append:    Keep the samples already stored for the day (a top-up)
+                     rather than clearing the row first
+        """
+        with self._lock:
+            row = self.rows.get(date_str)
+            new_row = row is None
+            if new_row:
+                row = len(self.rows)
+                # Growing the file zero fills the new row, which is MISSING.
+                with open(self.data_file, 'ab') as data_file:
+                    data_file.truncate((row + 1) * SECONDS_PER_DAY)
+            day = numpy.memmap(self.data_file, dtype='uint8', mode='r+', offset=row * SECONDS_PER_DAY,
+                               shape=(SECONDS_PER_DAY,))
+            if not append:
+                day[:] = MISSING
+            day[numpy.asarray(seconds, dtype='int64')] = values
+            day.flush()
+            del day
+            # Only publish the row once its samples are on disk.
+            if new_row:
+                self.rows[date_str] = row
+                self._save_index()
+
+    def write_series(self, series, append=False, storage=None):
+        """ Stores an IntradaySeries of heart rate.
+        With append the series only holds the samples added by a top-up.  If
+        the cube does not hold the day yet, the whole day is read back from
+        storage instead, so the new row is not left with only the top-up.
+        """
+        if append and series.date_str not in self.rows and storage is not None:
+            series = IntradaySeries.from_frame(storage.read_day('heartrate', series.date_str), 'heartrate',
+                                               series.date_str)
+            append = False
+        self.write_day(series.date_str, series.seconds, series.values, append=append)
+
+    def select(self, date_list):
+        """ Returns the dates of date_list held in the cube and their row numbers. """
+        dates = [d for d in date_list if d in self.rows]
+        return (dates, numpy.array([self.rows[d] for d in dates], dtype='int64'))
+
+    def blocks(self, date_list, block_rows=64):
+        """ Yields (dates, float32 array) blocks of rows with NaN for missing seconds. """
+        dates, rows = self.select(date_list)
+        cube = self.array()
+        for start in range(0, len(rows), block_rows):
+            yield (dates[start:start + block_rows], to_float(cube[rows[start:start + block_rows]]))
+
+    def totals(self, date_list, block_rows=64):
+        """ Returns the sum of the samples of each requested day held in the cube, a block of days at a time. """
+        dates = list()
+        sums = list()
+        for block_dates, block in self.blocks(date_list, block_rows):
+            dates.extend(block_dates)
+            sums.append(numpy.nansum(block, axis=1, dtype='float64'))
+        if not sums:
+            return (pd.Series(dtype='float64'))
+        return (pd.Series(numpy.concatenate(sums), index=dates))
+
+    def to_frame(self, date_list, index=None):
+        """ Returns a seconds x days float32 frame of the requested days, like the analysis merge frame. """
+        dates, rows = self.select(date_list)
+        grid = to_float(self.array()[rows]).T
+        if index is None:
+            index = pd.timedelta_range(start='00:00:00', periods=SECONDS_PER_DAY, freq='1s', name='Time')
+        return (pd.DataFrame(grid, index=index, columns=dates))
+
+    def stats(self, date_list, axis='index', block_size=64):
+        """ Returns generate_stats_df style statistics of the requested days.
+
+        axis 'index' gives one row per day (statistics over the seconds of the
+        day), 'columns' one row per second (statistics over the days).  The
+        cube is read block_size days, or block_size * 64 seconds, at a time.
+        """
+        dates, rows = self.select(date_list)
+        cube = self.array()
+        frames = list()
+        if axis in ('index', 0):
+            seconds = pd.timedelta_range(start='00:00:00', periods=SECONDS_PER_DAY, freq='1s')
+            for start in range(0, len(rows), block_size):
+                block = to_float(cube[rows[start:start + block_size]])
+                frames.append(stats_frame(block, 1, dates[start:start + block_size], seconds))
+        else:
+            seconds = pd.timedelta_range(start='00:00:00', periods=SECONDS_PER_DAY, freq='1s', name='Time')
+            step = block_size * 64
+            for start in range(0, SECONDS_PER_DAY, step):
+                block = to_float(cube[rows, start:start + step])
+                frames.append(stats_frame(block, 0, seconds[start:start + step], numpy.array(dates)))
+        if not frames:
+            return (pd.DataFrame(columns=STATS_COLUMNS))
+        return (pd.concat(frames))
+
+    def update_from_storage(self, storage, date_list=None, rebuild=False):
+        """ Loads the heart rate day files of a storage backend into the cube.
+        Args:
+          storage:    The storage backend holding the per-day files
+          date_list:  Days to load (default: every stored day)
+          rebuild:    Reload days already in the cube
+        Returns:
+          The number of days loaded.
+        """
+        if date_list is None:
+            date_list = storage.list_dates('heartrate')
+        if not rebuild:
+            date_list = [d for d in date_list if d not in self.rows]
+        for date_str in tqdm(date_list, desc='Updating heart rate cube', ascii=True):
+            series = IntradaySeries.from_frame(storage.read_day('heartrate', date_str), 'heartrate', date_str)
+            self.write_series(series)
+        logging.info('Loaded ' + str(len(date_list)) + ' days into ' + self.data_file)
+        return (len(date_list))
+
+
+def to_float(block):
+    """ Returns a uint8 block as float32 with NaN in place of the MISSING sentinel. """
+    block = numpy.asarray(block, dtype='float32')
+    block[block == MISSING] = numpy.nan
+    return (block)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Fitbit Cube',
+        description='Loads the heart rate day files of a directory into the memory-mapped heart rate cube.')
+    parser.add_argument('output_dir', help='Directory holding the data files', type=str)
+    parser.add_argument('--storage', help='Storage format of the data files (default: %(default)s)',
+                        choices=sorted(BACKENDS), default='csv', dest='storage')
+    parser.add_argument('--rebuild', help='Reload days already in the cube', action='store_true')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output_dir):
+        print('The output directory ' + str(args.output_dir) + ' does not exist.')
+        sys.exit(1)
+    try:
+        storage = get_storage(args.storage, args.output_dir)
+    except ImportError as err:
+        print(str(err))
+        sys.exit(1)
+    cube = HeartRateCube(args.output_dir)
+    count = cube.update_from_storage(storage, rebuild=args.rebuild)
+    print('Loaded ' + str(count) + ' days.  The cube holds ' + str(len(cube)) + ' days.')
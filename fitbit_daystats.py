@@ -0,0 +1,234 @@
+# /usr/bin/python3
+# -*- coding: utf-8 -*-
+# MIT License
+
+# Copyright (c) 2019 David Hunter
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+""" Per-day summary statistics computed as the tracker stores each day.
+
+Plotting the day statistics of a multi-year range used to mean loading every
+raw day file into the merge frame just to reduce each column to a handful of
+numbers.  When the tracker is run with --day_stats it summarizes each day as
+it normalizes the API response and keeps one row per day in a table per
+resource, next to the daily_summary table:
+
+  results/daily_stats_heartrate.csv   date, Samples, Total, Mean, Median, ...
+
+fitbit-analysis.py --plot_stats then reads the rows it needs from this table
+and only loads the day files of days the table does not hold.
+
+Each day is summarized by a DaySketch: the count, sum and sum of squares, the
+first min and max with their times, and a histogram of the values.  The
+samples are small integers (VALUE_DTYPES), so the histogram has one bin per
+value and the quantiles read from it are exact rather than approximate.  A
+sketch can be updated any number of times, so a day replayed from its full
+response and its top-ups gives the same row as the day read whole.  Existing
+directories can be summarized with:
+
+  python fitbit_daystats.py results
+
+"""
+import argparse
+import logging
+import os
+import sys
+
+import numpy as numpy
+import pandas as pd
+from tqdm import tqdm
+
+from fitbit_series import IntradaySeries
+from fitbit_storage import BACKENDS, RESOURCES, DailyTable, get_storage
+
+QUANTILES = {'P05': 0.05, 'P25': 0.25, 'P75': 0.75, 'P95': 0.95}
+DAY_STATS_COLUMNS = ['Samples', 'Total', 'Mean', 'Median', 'Min', 'Max', 'MinIdx', 'MaxIdx', 'StdDev'] + \
+    list(QUANTILES)
+
+
+def format_seconds(second):
+    """ Returns a second of day as HH:MM:SS. """
+    minutes, seconds = divmod(int(second), 60)
+    hours, minutes = divmod(minutes, 60)
+    return ('%02d:%02d:%02d' % (hours, minutes, seconds))
+
+
+class DaySketch(object):
+    """ Streaming summary of the integer samples of one day. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.squares = 0
+        self.min = None
+        self.max = None
+        self.min_second = None
+        self.max_second = None
+        self.counts = numpy.zeros(0, dtype='int64')
+
+    def update(self, seconds, values):
+        """ Adds samples, given in time order, to the sketch. """
+        values = numpy.asarray(values).astype('int64')
+        if len(values) == 0:
+            return
+        seconds = numpy.asarray(seconds)
+        self.count += len(values)
+        self.total += int(values.sum())
+        self.squares += int(numpy.dot(values, values))
+        # Ties keep the earlier sample, matching idxmin/idxmax.
+        low = int(values.argmin())
+        if self.min is None or values[low] < self.min:
+            self.min = int(values[low])
+            self.min_second = int(seconds[low])
+        high = int(values.argmax())
+        if self.max is None or values[high] > self.max:
+            self.max = int(values[high])
+            self.max_second = int(seconds[high])
+        counts = numpy.bincount(values, minlength=len(self.counts))
+        counts[:len(self.counts)] += self.counts
+        self.counts = counts
+
+    def update_series(self, series):
+        """ Adds the samples of an IntradaySeries. """
+        self.update(series.seconds, series.values)
+
+    def quantile(self, q):
+        """ Returns the q quantile, interpolated between samples like numpy.quantile. """
+        if self.count == 0:
+            return (numpy.nan)
+        cumulative = numpy.cumsum(self.counts)
+        position = q * (self.count - 1)
+        below = int(numpy.floor(position))
+        above = min(below + 1, self.count - 1)
+        low, high = numpy.searchsorted(cumulative, [below, above], side='right')
+        return (float(low + (high - low) * (position - below)))
+
+    def row(self):
+        """ Returns the DAY_STATS_COLUMNS of the day as a dict. """
+        if self.count == 0:
+            return ({column: numpy.nan for column in DAY_STATS_COLUMNS})
+        mean = self.total / float(self.count)
+        if self.count > 1:
+            std = float(numpy.sqrt(max(0.0, (self.squares - self.total * mean) / (self.count - 1))))
+        else:
+            std = numpy.nan
+        row = {'Samples': self.count, 'Total': self.total, 'Mean': mean, 'Median': self.quantile(0.5),
+               'Min': self.min, 'Max': self.max, 'MinIdx': format_seconds(self.min_second),
+               'MaxIdx': format_seconds(self.max_second), 'StdDev': std}
+        for column, q in QUANTILES.items():
+            row[column] = self.quantile(q)
+        return (row)
+
+
+class DayStatsTable(object):
+    """ The daily_stats_<resource> tables of a storage backend.
+    Args:
+      storage:  The storage backend holding the per-day files and the tables
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.tables = {resource: DailyTable(storage, 'daily_stats_' + resource) for resource in RESOURCES}
+
+    def update(self, resource, sketches):
+        """ Stores the rows of a dict of yyyy-mm-dd date to DaySketch. """
+        rows = {date_str: sketch.row() for date_str, sketch in sketches.items() if sketch.count}
+        if not rows:
+            return (None)
+        df = pd.DataFrame.from_dict(rows, orient='index', columns=DAY_STATS_COLUMNS)
+        return (self.tables[resource].update(df))
+
+    def record(self, series, append=False):
+        """ Summarizes the day of an IntradaySeries that has just been stored.
+        With append the series only holds the samples added by a top-up, so
+        the day is summarized from the stored file instead.
+        """
+        if append:
+            series = IntradaySeries.from_frame(self.storage.read_day(series.resource, series.date_str),
+                                               series.resource, series.date_str)
+        sketch = DaySketch()
+        sketch.update_series(series)
+        return (self.update(series.resource, {series.date_str: sketch}))
+
+    def read(self, resource, date_list=None):
+        """ Returns the stored rows, for the days of date_list that are held if given.
+        MinIdx and MaxIdx are returned as Timedeltas like generate_stats_df.
+        """
+        df = self.tables[resource].read()
+        if date_list is not None:
+            df = df.loc[df.index.intersection(pd.Index(date_list))]
+        for column in ('MinIdx', 'MaxIdx'):
+            if column in df:
+                df[column] = pd.to_timedelta(df[column])
+        return (df)
+
+    def update_from_storage(self, resource, date_list=None, rebuild=False):
+        """ Summarizes the stored day files of a resource.
+        Args:
+          resource:   heartrate, steps or sleep
+          date_list:  Days to summarize (default: every stored day)
+          rebuild:    Summarize days already in the table again
+        Returns:
+          The number of days summarized.
+        """
+        if date_list is None:
+            date_list = self.storage.list_dates(resource)
+        if not rebuild:
+            held = set(self.tables[resource].read().index)
+            date_list = [d for d in date_list if d not in held]
+        sketches = dict()
+        for date_str in tqdm(date_list, desc='Summarizing ' + resource, ascii=True):
+            sketch = DaySketch()
+            sketch.update_series(IntradaySeries.from_frame(self.storage.read_day(resource, date_str),
+                                                           resource, date_str))
+            sketches[date_str] = sketch
+        self.update(resource, sketches)
+        logging.info('Summarized ' + str(len(date_list)) + ' days of ' + resource)
+        return (len(date_list))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Fitbit Day Stats',
+        description='Summarizes the per-day data files of a directory into the daily statistics tables.')
+    parser.add_argument('output_dir', help='Directory holding the data files', type=str)
+    parser.add_argument('--storage', help='Storage format of the data files (default: %(default)s)',
+                        choices=sorted(BACKENDS), default='csv', dest='storage')
+    parser.add_argument('-t', '--type', help='Only summarize the type of data specified (heartrate, sleep, steps)',
+                        action='store', type=str, dest='collect_type')
+    parser.add_argument('--rebuild', help='Summarize days already in the tables again', action='store_true')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output_dir):
+        print('The output directory ' + str(args.output_dir) + ' does not exist.')
+        sys.exit(1)
+    try:
+        storage = get_storage(args.storage, args.output_dir)
+    except ImportError as err:
+        print(str(err))
+        sys.exit(1)
+    if args.collect_type:
+        resources = [r for r in RESOURCES if r in args.collect_type]
+    else:
+        resources = list(RESOURCES)
+    table = DayStatsTable(storage)
+    count = 0
+    for resource in resources:
+        count += table.update_from_storage(resource, rebuild=args.rebuild)
+    print('Summarized ' + str(count) + ' days.')
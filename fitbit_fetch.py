@@ -0,0 +1,538 @@
+# /usr/bin/python3
+# -*- coding: utf-8 -*-
+# MIT License
+
+# Copyright (c) 2019 David Hunter
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+""" Concurrent retrieval of day/resource pairs for fitbit-tracker.py
+
+Every (date, resource) pair the tracker collects is independent of every other
+pair, so the time spent on a multi-day backfill is almost entirely network
+latency.  The FetchEngine runs the per-day fetch functions from a bounded pool
+of worker threads so several requests are in flight at once.
+
+The Fitbit API allows 150 requests per user per hour.  Rather than refusing
+large ranges, every request first takes a token from a RateLimiter.  The
+limiter is a token bucket whose state is persisted between runs and corrected
+from the Fitbit-Rate-Limit-* response headers, so when the hourly budget is
+spent the workers sleep until the window resets and then carry on.
+
+A TokenManager owns the OAuth2 token for the single shared client.  It keeps
+the token in memory, serializes refreshes between worker threads and only
+rewrites the configuration file (atomically) when the token actually changes.
+
+API responses are logged through log_payload, which only serializes them when
+debug logging is on and then only as a summary (sample counts plus the first
+and last points).  Full responses can be sent to a separate rotating archive
+with set_payload_archive instead of the main log.
+
+A CheckpointJournal in the output directory records the outcome of every
+(date, resource) pair so an interrupted backfill can be resumed without
+refetching the days already on disk.
+
+"""
+import concurrent.futures
+import json
+import logging
+import logging.handlers
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import fitbit
+from requests.adapters import HTTPAdapter
+
+# A single unit of work: collect one resource for one day.
+FetchTask = namedtuple('FetchTask', ['date_str', 'resource'])
+
+# The outcome of a task.  value is whatever the fetch function returned.
+FetchResult = namedtuple('FetchResult', ['task', 'value', 'elapsed'])
+
+RESOURCES = ('heartrate', 'steps', 'sleep')
+
+
+def get_resources(collect_type):
+    """ Returns the per-day resources selected by the collect_type option ('daily' selects every resource). """
+    if 'daily' in collect_type:
+        return (list(RESOURCES))
+    return ([r for r in RESOURCES if r in collect_type])
+
+
+def build_tasks(date_list, collect_type):
+    """ Returns the list of FetchTasks for the given days and collection type.
+    Args:
+      date_list:    List of yyyy-mm-dd strings to collect
+      collect_type: The collect_type option ('daily' collects every resource)
+    Returns:
+      A list of FetchTask tuples ordered by date and then resource.
+    """
+    resources = get_resources(collect_type)
+
+    tasks = list()
+    for date_str in date_list:
+        for resource in resources:
+            tasks.append(FetchTask(date_str, resource))
+    return (tasks)
+
+
+# Lists longer than this are summarized when a payload is logged.
+SUMMARY_ITEMS = 3
+
+# Full payloads go to this logger, which has no handler unless an archive is set.
+PAYLOAD_LOGGER = logging.getLogger('fitbit-payload')
+PAYLOAD_LOGGER.propagate = False
+
+
+def summarize_payload(payload, max_items=SUMMARY_ITEMS):
+    """ Returns a copy of a payload with long lists replaced by their count and end points. """
+    if isinstance(payload, dict):
+        return ({key: summarize_payload(value, max_items) for key, value in payload.items()})
+    if isinstance(payload, list):
+        if len(payload) > 2 * max_items:
+            return ({'count': len(payload),
+                     'first': [summarize_payload(v, max_items) for v in payload[:max_items]],
+                     'last': [summarize_payload(v, max_items) for v in payload[-max_items:]]})
+        return ([summarize_payload(v, max_items) for v in payload])
+    return (payload)
+
+
+def set_payload_archive(file_name, max_bytes=50 * 1024 * 1024, backup_count=5):
+    """ Sends full API payloads, one JSON line each, to a rotating file. """
+    handler = logging.handlers.RotatingFileHandler(file_name, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    PAYLOAD_LOGGER.addHandler(handler)
+    PAYLOAD_LOGGER.setLevel(logging.DEBUG)
+
+
+def log_payload(resource, date_str, payload):
+    """ Logs an API response without paying for serialization unless it is wanted. """
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(resource + ' ' + str(date_str) + ': ' + json.dumps(summarize_payload(payload)))
+    if PAYLOAD_LOGGER.handlers:
+        PAYLOAD_LOGGER.debug(json.dumps({'resource': resource, 'date': str(date_str), 'payload': payload}))
+
+
+def write_json_atomic(file_name, data):
+    """ Writes json to a temporary file in the same directory and renames it into place. """
+    file_dir = os.path.dirname(os.path.abspath(file_name))
+    fd, tmp_name = tempfile.mkstemp(dir=file_dir, prefix='.' + os.path.basename(file_name) + '-')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(data, tmp_file, indent=4)
+        os.replace(tmp_name, file_name)
+    except Exception:
+        os.unlink(tmp_name)
+        raise
+
+
+class FetchCancelled(Exception):
+    """ Raised by RateLimiter.acquire once the limiter has been cancelled. """
+
+
+class RateLimiter(object):
+    """ Token bucket that paces requests to stay inside the Fitbit hourly quota.
+
+    The bucket holds up to capacity tokens and refills at capacity/period
+    tokens per second.  When the server reports how many requests remain and
+    when the window resets, that takes precedence: the bucket is set to the
+    remaining count and refills completely once the reset time is reached.
+
+    If state_file is given, the bucket is loaded from and saved to that file so
+    requests made by earlier runs within the same hour are accounted for.
+
+    cancel() wakes every acquire waiting for quota and makes it raise
+    FetchCancelled, so a failed run does not wait out the window and then
+    spend requests; resume() allows requests again.
+    """
+
+    # Longest sleep before the bucket is checked again for fresher quota headers.
+    POLL_SECS = 60
+
+    def __init__(self, capacity=150, period=3600, state_file=None,
+                 clock=time.time, sleep=None):
+        self.capacity = capacity
+        self.period = period
+        self.state_file = state_file
+        self._clock = clock
+        self._cancelled = threading.Event()
+        # By default waits end early when the limiter is cancelled.
+        self._sleep = sleep if sleep is not None else self._cancelled.wait
+        self._lock = threading.Lock()
+        self.tokens = float(capacity)
+        self.updated = clock()
+        self.reset_at = None
+        self.load()
+
+    @property
+    def rate(self):
+        """ Tokens added per second when no server reset time is known. """
+        return (self.capacity / float(self.period))
+
+    def load(self):
+        """ Restores the bucket from the state file if there is one. """
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as state:
+                data = json.load(state)
+            self.tokens = min(float(data['tokens']), self.capacity)
+            self.updated = float(data['updated'])
+            self.reset_at = data.get('reset_at')
+        except (ValueError, KeyError, TypeError):
+            logging.warning('Ignoring unreadable rate limit state file ' + self.state_file)
+
+    def save(self):
+        """ Writes the bucket to the state file using a temporary file and rename. """
+        if not self.state_file:
+            return
+        data = {'tokens': self.tokens, 'updated': self.updated, 'reset_at': self.reset_at}
+        write_json_atomic(self.state_file, data)
+
+    def _refill(self, now):
+        """ Adds the tokens earned since the last update. Caller holds the lock. """
+        if self.reset_at is not None:
+            if now >= self.reset_at:
+                self.tokens = float(self.capacity)
+                self.reset_at = None
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """ Returns the number of seconds until a token will be available. """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            if self.tokens >= 1:
+                return (0.0)
+            elif self.reset_at is not None:
+                return (max(0.0, self.reset_at - now))
+            return ((1 - self.tokens) / self.rate)
+
+    def acquire(self):
+        """ Blocks until a token is available and takes it.
+        The lock is released while sleeping, so responses still in flight can
+        update the bucket, and the wait is re-checked at least every
+        POLL_SECS seconds.
+        """
+        resume = None
+        while True:
+            if self._cancelled.is_set():
+                raise FetchCancelled('Request quota wait cancelled')
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.save()
+                    return
+                if self.reset_at is not None:
+                    delay = max(1.0, self.reset_at - now)
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            wake = datetime.fromtimestamp(now + delay).strftime('%H:%M:%S')
+            if wake != resume:
+                logging.info('Request quota used. Sleeping until ' + wake)
+                resume = wake
+            self._sleep(min(delay, self.POLL_SECS))
+
+    def cancel(self):
+        """ Makes waiting and future acquires raise FetchCancelled. """
+        self._cancelled.set()
+
+    def resume(self):
+        """ Allows acquires again after cancel. """
+        self._cancelled.clear()
+
+    def update_from_headers(self, headers):
+        """ Corrects the bucket using the Fitbit-Rate-Limit-* response headers. """
+        remaining = headers.get('Fitbit-Rate-Limit-Remaining')
+        reset = headers.get('Fitbit-Rate-Limit-Reset')
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            now = self._clock()
+            self.tokens = float(remaining)
+            self.reset_at = now + int(reset)
+            self.updated = now
+            self.save()
+
+    def penalize(self, retry_after=None):
+        """ Empties the bucket after a 429 response until retry_after seconds have passed. """
+        with self._lock:
+            now = self._clock()
+            if retry_after is None:
+                # Fitbit resets the quota at the top of the hour.
+                retry_after = self.period - (now % self.period)
+            self.tokens = 0.0
+            self.reset_at = now + retry_after
+            self.updated = now
+            self.save()
+
+    def attach(self, session):
+        """ Registers a response hook on a requests session to read the quota headers. """
+        def hook(response, *args, **kwargs):
+            self.update_from_headers(response.headers)
+        session.hooks['response'].append(hook)
+
+
+class TokenManager(object):
+    """ Holds the OAuth2 token from the configuration file for one shared client.
+
+    The configuration is read once.  update() is the refresh callback: it
+    records the new token in memory and persists it only if it differs from
+    the current one.  Refreshes are serialized so that several worker threads
+    hitting an expired token only spend the (single use) refresh token once.
+    """
+    # A refresh within this many seconds is reused rather than repeated.
+    REFRESH_REUSE_SECS = 60
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        with open(config_file) as json_config_file:
+            self.config = json.load(json_config_file)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = 0.0
+
+    @property
+    def access_token(self):
+        return (self.config['access_token'])
+
+    @property
+    def refresh_token(self):
+        return (self.config['refresh_token'])
+
+    def update(self, token):
+        """ Called when the access token has been refreshed. """
+        with self._lock:
+            if (token['access_token'] == self.config.get('access_token') and
+                    token['refresh_token'] == self.config.get('refresh_token')):
+                return
+            self.config['access_token'] = token['access_token']
+            self.config['refresh_token'] = token['refresh_token']
+            if 'expires_at' in token:
+                self.config['token_expires'] = token['expires_at']
+                logging.info('New token will expire at: ' + str(datetime.fromtimestamp(token['expires_at'])))
+            logging.info('Refreshing token.')
+            write_json_atomic(self.config_file, self.config)
+
+    def _guard_refresh(self, session):
+        """ Wraps the session refresh so concurrent callers share a single refresh. """
+        refresh = session.refresh_token
+
+        def locked_refresh(token_url, *args, **kwargs):
+            with self._refresh_lock:
+                if time.time() - self._last_refresh < self.REFRESH_REUSE_SECS:
+                    return (session.token)
+                token = refresh(token_url, *args, **kwargs)
+                self._last_refresh = time.time()
+                return (token)
+        session.refresh_token = locked_refresh
+
+    def create_client(self, pool_size=10):
+        """ Returns the oauth2 fitbit client sharing one pooled HTTP session.
+        Args:
+          pool_size:  Number of connections kept open, normally the worker count.
+        """
+        client = fitbit.Fitbit(self.config['client_id'], self.config['client_secret'], oauth2=True,
+                               access_token=self.access_token, refresh_token=self.refresh_token,
+                               refresh_cb=self.update)
+        session = client.client.session
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1)))
+        self._guard_refresh(session)
+        return (client)
+
+
+class CheckpointJournal(object):
+    """ Append only record of which (date, resource) pairs have been fetched.
+
+    Each line of the journal file is a JSON object with the date, resource,
+    status ('done', 'empty' or 'failed') and a timestamp.  The last entry for a
+    pair wins, so a pair that failed and later succeeded is complete.
+
+    Successful fetches of days that were entirely in the past are marked as
+    final; those files can never gain more data.
+    """
+    JOURNAL_NAME = 'fitbit-journal.jsonl'
+    COMPLETE = ('done', 'empty')
+
+    def __init__(self, output_dir):
+        self.file_name = os.path.join(output_dir, self.JOURNAL_NAME)
+        self._lock = threading.Lock()
+        self.status = dict()
+        self.final = set()
+        self.load()
+
+    def load(self):
+        """ Reads the existing journal, ignoring a partially written last line. """
+        if not os.path.exists(self.file_name):
+            return
+        with open(self.file_name) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                    key = (entry['date'], entry['resource'])
+                    self.status[key] = entry['status']
+                    if entry.get('final'):
+                        self.final.add(key)
+                except (ValueError, KeyError):
+                    logging.warning('Skipping unreadable journal entry: ' + line.strip())
+
+    def record(self, task, status, error=None):
+        """ Appends the outcome of a task to the journal. """
+        entry = {'date': task.date_str, 'resource': task.resource, 'status': status,
+                 'time': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
+        if error is not None:
+            entry['error'] = error
+        final = status in self.COMPLETE and task.date_str < datetime.now().strftime('%Y-%m-%d')
+        if final:
+            entry['final'] = True
+        with self._lock:
+            self.status[(task.date_str, task.resource)] = status
+            if final:
+                self.final.add((task.date_str, task.resource))
+            with open(self.file_name, 'a') as journal:
+                journal.write(json.dumps(entry) + '\n')
+
+    def is_complete(self, task):
+        """ True if the task has already been fetched successfully. """
+        return (self.status.get((task.date_str, task.resource)) in self.COMPLETE)
+
+    def is_final(self, task):
+        """ True if the task was fetched after its day had ended. """
+        return ((task.date_str, task.resource) in self.final)
+
+    def failed(self):
+        """ Returns the list of tasks whose last attempt failed. """
+        return ([FetchTask(d, r) for (d, r), status in sorted(self.status.items()) if status == 'failed'])
+
+    def pending(self, tasks):
+        """ Returns the tasks that have not been completed. """
+        return ([task for task in tasks if not self.is_complete(task)])
+
+
+class FetchEngine(object):
+    """ Fetches independent day/resource pairs using a bounded pool of threads.
+
+    fetchers maps a resource name to a callable taking the yyyy-mm-dd date
+    string.  The callable is responsible for storing its own results (the
+    get_heartrate/get_steps/get_sleep functions write their csv file), so each
+    file is written as soon as its request completes.
+
+    At most max_workers requests are in flight.  If a limiter is given each
+    request first takes a token from it, and a request failing with one of the
+    retry_exceptions (e.g. HTTPTooManyRequests) empties the limiter and is
+    retried up to max_retries times once the quota window has reset.
+
+    If a journal is given, the outcome of every task is recorded in it.
+    """
+
+    def __init__(self, fetchers, max_workers=4, limiter=None, retry_exceptions=(), max_retries=3,
+                 journal=None):
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than zero')
+        self.fetchers = fetchers
+        self.max_workers = max_workers
+        self.limiter = limiter
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.max_retries = max_retries
+        self.journal = journal
+        self.completed = list()
+
+    def _fetch(self, task):
+        """ Runs a single task in a worker thread and times it. """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                value = self.fetchers[task.resource](task.date_str)
+                break
+            except self.retry_exceptions as err:
+                attempt += 1
+                if self.limiter is None or attempt > self.max_retries:
+                    raise
+                logging.warning('Rate limited fetching ' + task.resource + ' for ' + task.date_str +
+                                '. Retry ' + str(attempt) + ' of ' + str(self.max_retries))
+                self.limiter.penalize(getattr(err, 'retry_after_secs', None))
+        return (FetchResult(task, value, time.monotonic() - start))
+
+    def run(self, tasks, progress=None):
+        """ Fetches the tasks and yields a FetchResult as each one completes.
+
+        If a fetch raises, outstanding tasks are cancelled, workers waiting
+        for quota are woken by cancelling the limiter, and the exception is
+        re-raised with the failing task attached as the fetch_task attribute so
+        the caller can report where it stopped.
+        """
+        if self.limiter is not None:
+            # The limiter is shared by the daemon's runs.
+            self.limiter.resume()
+        # Keep a small window of submitted work rather than queueing every
+        # task so a failure stops the run quickly.
+        window = self.max_workers * 2
+        pending = dict()
+        queue = iter(tasks)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            for task in queue:
+                pending[executor.submit(self._fetch, task)] = task
+                if len(pending) >= window:
+                    break
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        err.fetch_task = task
+                        if self.journal is not None:
+                            self.journal.record(task, 'failed', error=type(err).__name__)
+                        raise
+                    if self.journal is not None:
+                        # The fetch functions return an empty tuple when there is no data.
+                        if isinstance(result.value, tuple) and len(result.value) == 0:
+                            self.journal.record(task, 'empty')
+                        else:
+                            self.journal.record(task, 'done')
+                    logging.debug('Fetched ' + task.resource + ' for ' + task.date_str +
+                                  ' in ' + '{:.2f}'.format(result.elapsed) + 's')
+                    self.completed.append(task)
+                    if progress is not None:
+                        progress.update()
+                    yield result
+                for task in queue:
+                    pending[executor.submit(self._fetch, task)] = task
+                    if len(pending) >= window:
+                        break
+        finally:
+            for future in pending:
+                future.cancel()
+            if self.limiter is not None:
+                # Workers still waiting for quota give up rather than spending
+                # it after the run has stopped.
+                self.limiter.cancel()
+            executor.shutdown(wait=True)
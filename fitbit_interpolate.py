@@ -0,0 +1,110 @@
+# /usr/bin/python3
+# -*- coding: utf-8 -*-
+# MIT License
+
+# Copyright (c) 2019 David Hunter
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+""" Bounded linear interpolation of missing intraday samples.
+
+Interpolating the whole wide frame with pandas fills every gap, so a device
+taken off the wrist for the night gets hours of fabricated heart rate, and it
+costs a pass over every day even where nothing is missing.  fill_gaps works
+on one day of samples held as compact (slot, value) arrays instead: it only
+fills gaps between two real samples that are at most max_gap slots long, never
+extends a day past its first or last sample, and reports the slots it
+synthesized so they can be told apart from measured ones.
+
+fitbit-analysis.py runs it in the worker processes that read the day files,
+so the days are interpolated in parallel before the wide frame is built.
+
+"""
+import concurrent.futures
+import itertools
+
+import numpy as numpy
+import pandas as pd
+
+
+def fill_gaps(positions, values, max_gap):
+    """ Fills the short gaps of one day of samples.
+    Args:
+      positions:  Integer slots of the samples in the day's time index
+      values:     The samples
+      max_gap:    Longest run of missing slots that is filled
+    Returns:
+      A tuple of the positions and float32 values with the gaps filled, and the
+      positions that were synthesized.
+    """
+    positions = numpy.asarray(positions).astype('int64')
+    values = numpy.asarray(values).astype('float32')
+    if numpy.any(numpy.diff(positions) < 0):
+        # Sleep that starts before midnight wraps around the time of day.
+        order = numpy.argsort(positions, kind='stable')
+        positions = positions[order]
+        values = values[order]
+    gaps = numpy.diff(positions) - 1
+    fill = (gaps > 0) & (gaps <= max_gap)
+    if not fill.any():
+        return (positions, values, numpy.zeros(0, dtype='int64'))
+    lengths = gaps[fill]
+    # Number the missing slots of each gap 1..length after the sample before it.
+    starts = numpy.cumsum(lengths) - lengths
+    offsets = numpy.arange(lengths.sum()) - numpy.repeat(starts, lengths) + 1
+    synthesized = numpy.repeat(positions[:-1][fill], lengths) + offsets
+    filled = numpy.interp(synthesized, positions, values).astype('float32')
+    order = numpy.argsort(numpy.concatenate([positions, synthesized]), kind='stable')
+    return (numpy.concatenate([positions, synthesized])[order], numpy.concatenate([values, filled])[order],
+            synthesized)
+
+
+def fill_column(column, max_gap):
+    """ Returns a copy of one NaN padded day column with its short gaps filled, and the synthesized mask. """
+    column = numpy.asarray(column, dtype='float32')
+    present = numpy.flatnonzero(~numpy.isnan(column))
+    positions, values, synthesized = fill_gaps(present, column[present], max_gap)
+    filled = column.copy()
+    filled[positions] = values
+    mask = numpy.zeros(len(column), dtype='bool')
+    mask[synthesized] = True
+    return (filled, mask)
+
+
+def interpolate_frame(df, max_gap, workers=1):
+    """ Fills the short gaps of every day column of a wide frame.
+    Args:
+      df:       A time of day x days frame with NaN for missing samples
+      max_gap:  Longest run of missing slots that is filled
+      workers:  Number of worker processes, 1 works in this process
+    Returns:
+      A tuple of the filled frame and a boolean frame marking the synthesized samples.
+    """
+    columns = [df[name].values for name in df.columns]
+    if workers <= 1 or len(columns) <= 1:
+        results = [fill_column(column, max_gap) for column in columns]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(fill_column, columns, itertools.repeat(max_gap)))
+    filled = numpy.empty(df.shape, dtype='float32')
+    mask = numpy.zeros(df.shape, dtype='bool')
+    for col, (values, synthesized) in enumerate(results):
+        filled[:, col] = values
+        mask[:, col] = synthesized
+    return (pd.DataFrame(filled, index=df.index, columns=df.columns),
+            pd.DataFrame(mask, index=df.index, columns=df.columns))
@@ -0,0 +1,276 @@
+# /usr/bin/python3
+# -*- coding: utf-8 -*-
+# MIT License
+
+# Copyright (c) 2019 David Hunter
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+""" Summary and sample plots of the analyzed data, shown or rendered to files.
+
+The figures are described by plain dicts of numpy arrays (see summary_figures
+and series_figures) and drawn by draw_figure, so the same description can be
+shown interactively or sent to worker processes that render it with the Agg
+backend to png or svg files (render_figures).  Nothing here needs a display.
+
+Long series are reduced before they are drawn.  The samples are split into
+one bucket per pixel column of the figure and only the minimum and maximum of
+each bucket are kept, so a spike still shows but years of one second heart
+rate are drawn as a few thousand points.  series_figures buckets the wide
+time of day x days frames a day at a time, so the samples are never copied
+into one long series.
+
+"""
+import concurrent.futures
+import os
+
+import numpy as numpy
+import pandas as pd
+from tqdm import tqdm
+
+PLOT_FORMATS = ('png', 'svg')
+# Figures per resource: one for the whole range, or one per year or month.
+PLOT_PERIODS = {'all': None, 'year': 'Y', 'month': 'M'}
+FIGURE_SIZE = (12, 6)
+FIGURE_DPI = 100
+PIXEL_COLUMNS = FIGURE_SIZE[0] * FIGURE_DPI
+Y_LABELS = {'heartrate': 'Heartrate', 'steps': 'Steps', 'sleep': 'Sleep Stage'}
+
+
+def import_plotting(headless=False):
+    """ Imports pyplot and registers the pandas converters on first use.
+    Only runs that plot pay for importing matplotlib.
+    Args:
+      headless:  Select the Agg backend, which needs no display
+    Returns:
+      The matplotlib.pyplot module.
+    """
+    import matplotlib
+    # This allows the saving of .png files.  NB.  This must come before
+    # import the pyplot library.
+    if headless:
+        matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    from pandas.plotting import register_matplotlib_converters
+    register_matplotlib_converters()
+    # The seaborn styles were renamed in matplotlib 3.6.
+    for style in ('seaborn-v0_8-white', 'seaborn-white'):
+        if style in plt.style.available:
+            plt.style.use(style)
+            break
+    return (plt)
+
+
+def min_max_buckets(x, low, high, columns=PIXEL_COLUMNS):
+    """ Reduces a series to the minimum and maximum of each of at most columns buckets.
+    Args:
+      x:        Sorted positions of the samples
+      low:      Values whose minimum is kept
+      high:     Values whose maximum is kept (low again for a plain series)
+      columns:  Largest number of buckets
+    Returns:
+      A tuple of the first position, minimum and maximum of each bucket.
+      Buckets without samples are NaN.
+    """
+    size = -(-len(x) // columns)
+    if size <= 1:
+        return (x, low, high)
+    pad = -len(x) % size
+    low = numpy.concatenate([low.astype('float64'), numpy.full(pad, numpy.nan)])
+    high = numpy.concatenate([high.astype('float64'), numpy.full(pad, numpy.nan)])
+    # fmin/fmax skip NaN and leave a bucket of only NaN as NaN without a warning.
+    low = numpy.fmin.reduce(low.reshape(-1, size), axis=1)
+    high = numpy.fmax.reduce(high.reshape(-1, size), axis=1)
+    return (x[::size], low, high)
+
+
+def interleave(x, low, high):
+    """ Returns the points of a line that passes through the minimum and maximum of each bucket. """
+    if low is high:
+        return (x, low)
+    return (numpy.repeat(x, 2), numpy.column_stack([low, high]).ravel())
+
+
+def periods(index, period):
+    """ Splits dates into the periods of a figure each.
+    Args:
+      index:   DatetimeIndex of the days
+      period:  A key of PLOT_PERIODS
+    Returns:
+      A list of (label, boolean mask of index) pairs, label None for 'all'.
+    """
+    if PLOT_PERIODS[period] is None:
+        return ([(None, numpy.ones(len(index), dtype='bool'))])
+    labels = index.to_period(PLOT_PERIODS[period])
+    return ([(str(label), numpy.asarray(labels == label)) for label in labels.unique()])
+
+
+def figure_name(resource, kind, label, plot_format):
+    """ Returns the file name of a figure, e.g. heartrate_summary_2019-01.png """
+    parts = [resource, kind] + ([label] if label else [])
+    return ('_'.join(parts) + '.' + plot_format)
+
+
+def summary_figures(resource, day_summary_df, period='all'):
+    """ Describes the day statistics plots of a resource.
+    Args:
+      resource:        heartrate, steps or sleep
+      day_summary_df:  Day statistics with a DatetimeIndex (see generate_stats_df)
+      period:          A key of PLOT_PERIODS
+    Returns:
+      A list of figure dicts for draw_figure.
+    """
+    figures = list()
+    for label, mask in periods(day_summary_df.index, period):
+        df = day_summary_df[mask]
+        x = df.index.values
+        if resource == 'heartrate':
+            lines = list()
+            for column, style in (('Min', 'b-'), ('Max', 'r-'), ('Median', 'g-')):
+                y = df[column].values
+                lines.append((column + ' Heartrate', style, min_max_buckets(x, y, y)))
+            bars = None
+        else:
+            column, bar_label = ('Total', 'Total Steps') if resource == 'steps' else ('Mean', 'Sleep Stage')
+            y = df[column].values
+            lines = list()
+            bars = (bar_label, min_max_buckets(x, y, y))
+        figures.append({'resource': resource, 'kind': 'summary', 'label': label,
+                        'title': 'Fitbit Readings Over Time' + (' ' + label if label else ''),
+                        'x_label': 'Date', 'lines': lines, 'bars': bars, 'band': None})
+    return (figures)
+
+
+def series_figures(resource, merge_df, period='all'):
+    """ Describes the plots of every sample of a resource.
+    Args:
+      resource:  heartrate, steps or sleep
+      merge_df:  Time of day x days frame with a yyyy-mm-dd column per day
+      period:    A key of PLOT_PERIODS
+    Returns:
+      A list of figure dicts for draw_figure.  Each day is reduced to its
+      share of the figure's pixel columns before the days are put together,
+      and days without a file are left empty.
+    """
+    figures = list()
+    days = pd.to_datetime(merge_df.columns)
+    offsets = merge_df.index.values
+    slots = len(offsets)
+    values = merge_df.values
+    for label, mask in periods(days, period):
+        calendar = pd.date_range(days[mask].min(), days[mask].max(), freq='D')
+        size = -(-slots // max(1, PIXEL_COLUMNS // len(calendar)))
+        per_day = -(-slots // size)
+        low = numpy.full((len(calendar), per_day), numpy.nan)
+        high = numpy.full((len(calendar), per_day), numpy.nan)
+        pad = numpy.full(per_day * size - slots, numpy.nan)
+        for col, row in zip(numpy.flatnonzero(mask), calendar.get_indexer(days[mask])):
+            day = numpy.concatenate([values[:, col], pad]).reshape(per_day, size)
+            low[row] = numpy.fmin.reduce(day, axis=1)
+            high[row] = numpy.fmax.reduce(day, axis=1)
+        x = (calendar.values[:, None] + offsets[::size][None, :]).ravel()
+        band = min_max_buckets(x, low.ravel(), high.ravel())
+        figures.append({'resource': resource, 'kind': 'series', 'label': label,
+                        'title': 'Fitbit ' + Y_LABELS[resource] + ' Samples' + (' ' + label if label else ''),
+                        'x_label': 'Time', 'lines': list(), 'bars': None, 'band': band})
+    return (figures)
+
+
+def draw_figure(plt, figure):
+    """ Draws a figure dict (see summary_figures) and returns the matplotlib figure. """
+    import matplotlib.dates as md
+    from matplotlib.ticker import AutoMinorLocator
+    fig = plt.figure(figsize=FIGURE_SIZE, dpi=FIGURE_DPI)
+
+    ax = fig.gca()
+    locator = md.AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(md.ConciseDateFormatter(locator))
+    ax.yaxis.set_major_locator(plt.MaxNLocator())
+    ax.yaxis.set_minor_locator(AutoMinorLocator())
+    ax.tick_params(axis='both', labelsize='small',
+                   labelrotation=0, length=10,
+                   direction='out', grid_alpha=0)
+    ax.set_xmargin(0.005)
+    ax.set_title(figure['title'], pad=20, loc='center', fontsize=24)
+    ax.set_xlabel(figure['x_label'], labelpad=20, fontsize=14, color='blue')
+    ax.set_ylabel(Y_LABELS[figure['resource']], labelpad=20, fontsize=14, color='blue')
+
+    for label, style, (x, low, high) in figure['lines']:
+        ax.plot(*interleave(x, low, high), style, label=label)
+    if figure['bars'] is not None:
+        label, (x, low, high) = figure['bars']
+        if low is high:
+            ax.bar(x, low, color='grey', orientation='vertical', label=label)
+        else:
+            # More days than pixel columns, draw the outline of the bars.
+            ax.fill_between(x, 0, high, step='post', color='grey', label=label)
+    if figure['band'] is not None:
+        x, low, high = figure['band']
+        ax.fill_between(x, low, high, step='post', color='grey', linewidth=0.5, label='Min/Max')
+    ax.legend(loc='upper center', frameon=True, ncol=3, fancybox=True)
+    return (fig)
+
+
+def render_figure(figure, path):
+    """ Draws a figure dict to a png or svg file.  Runs in the worker processes.
+    Returns:
+      The path written.
+    """
+    plt = import_plotting(headless=True)
+    fig = draw_figure(plt, figure)
+    fig.savefig(path, dpi=FIGURE_DPI, bbox_inches='tight')
+    plt.close(fig)
+    return (path)
+
+
+def render_figures(figures, plot_dir, plot_format='png', workers=1):
+    """ Renders figure dicts to files with a pool of worker processes.
+    Args:
+      figures:      List of figure dicts
+      plot_dir:     Directory the files are written to, created if needed
+      plot_format:  One of PLOT_FORMATS
+      workers:      Number of worker processes.  1 renders in this process.
+    Returns:
+      The list of files written.
+    """
+    os.makedirs(plot_dir, exist_ok=True)
+    paths = [os.path.join(plot_dir, figure_name(f['resource'], f['kind'], f['label'], plot_format))
+             for f in figures]
+    prog_bar = tqdm(total=len(figures), desc='Rendering Plots', ascii=True)
+    written = list()
+    if workers <= 1 or len(figures) <= 1:
+        for figure, path in zip(figures, paths):
+            written.append(render_figure(figure, path))
+            prog_bar.update()
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(figures))) as executor:
+            for path in executor.map(render_figure, figures, paths):
+                written.append(path)
+                prog_bar.update()
+    prog_bar.close()
+    return (written)
+
+
+def show_figures(figures):
+    """ Draws figure dicts in windows of their own and shows them. """
+    plt = import_plotting()
+    for figure in figures:
+        draw_figure(plt, figure)
+    # Only call this at the end, it blocks until the windows are closed.
+    plt.show()
@@ -0,0 +1,133 @@
+# /usr/bin/python3
+# -*- coding: utf-8 -*-
+# MIT License
+
+# Copyright (c) 2019 David Hunter
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+""" Helpers for turning Fitbit intraday payloads into time series.
+
+The intraday API reports each sample with a bare HH:MM:SS time of day.  A
+full day of 1 second heart rate is 86,400 of them, so building timestamps by
+concatenating the date onto every string and running the generic datetime
+parser is slow.  These helpers decode the fixed width strings with numpy
+arithmetic instead and add the resulting seconds to a single day start.
+
+A day of samples is held as an IntradaySeries: uint32 seconds of day and the
+values in the narrowest integer type the resource needs.  A day of 1 second
+heart rate then takes about 430 KB instead of the ~10 MB of a json_normalize
+frame with object time strings and int64 values, which lets a multi-year
+range be held in memory.
+
+"""
+import numpy as numpy
+import pandas as pd
+
+
+def seconds_of_day(times):
+    """ Converts a sequence of HH:MM:SS strings into int32 seconds since midnight. """
+    if len(times) == 0:
+        return (numpy.zeros(0, dtype='int32'))
+    raw = numpy.asarray(times, dtype='S8').view('uint8').reshape(-1, 8)
+    digits = raw[:, [0, 1, 3, 4, 6, 7]].astype('int32') - ord('0')
+    if not numpy.all(raw[:, [2, 5]] == ord(':')) or digits.min() < 0 or digits.max() > 9:
+        # Not the fixed width format the API uses, fall back to pandas.
+        return ((pd.to_timedelta(pd.Series(times).astype(str)).values // 1000000000).astype('int32'))
+    return ((digits[:, 0] * 10 + digits[:, 1]) * 3600 +
+            (digits[:, 2] * 10 + digits[:, 3]) * 60 +
+            (digits[:, 4] * 10 + digits[:, 5]))
+
+
+def time_to_seconds(time_str):
+    """ Converts a single HH:MM:SS string into seconds since midnight. """
+    hours, minutes, seconds = time_str.split(':')
+    return (int(hours) * 3600 + int(minutes) * 60 + int(seconds))
+
+
+def day_timestamps(date_str, seconds):
+    """ Returns a DatetimeIndex of the day start plus the given seconds of day. """
+    day_start = numpy.datetime64(date_str, 'ns')
+    return (pd.DatetimeIndex(day_start + seconds.astype('int64') * numpy.timedelta64(1, 's')))
+
+
+# Narrowest dtype holding each resource's values.  Heart rate in bpm and the
+# sleep stage fit in a byte, steps per minute in two.
+VALUE_DTYPES = {'heartrate': 'uint8', 'steps': 'uint16', 'sleep': 'uint8'}
+
+
+def narrow_values(values, dtype):
+    """ Returns the values as dtype, clipped to its range rather than wrapped. """
+    values = numpy.asarray(values)
+    if values.dtype == dtype:
+        return (values)
+    info = numpy.iinfo(dtype)
+    return (numpy.clip(values.astype('int64'), info.min, info.max).astype(dtype))
+
+
+class IntradaySeries(object):
+    """ One day of samples for one resource held as two compact arrays.
+    Args:
+      date_str:  The yyyy-mm-dd day the samples belong to
+      resource:  heartrate, steps or sleep
+      seconds:   Seconds since midnight of each sample, stored as uint32
+      values:    The samples, stored in the VALUE_DTYPES type of the resource
+    """
+    __slots__ = ('date_str', 'resource', 'seconds', 'values')
+
+    def __init__(self, date_str, resource, seconds, values):
+        self.date_str = date_str
+        self.resource = resource
+        self.seconds = numpy.asarray(seconds, dtype='uint32')
+        self.values = narrow_values(values, VALUE_DTYPES[resource])
+
+    @classmethod
+    def from_dataset(cls, date_str, resource, dataset, time_key='time'):
+        """ Builds a series from an API dataset, a list of {time, value} dicts. """
+        times = [sample[time_key] for sample in dataset]
+        values = numpy.array([sample['value'] for sample in dataset]).astype('int64')
+        return (cls(date_str, resource, seconds_of_day(times), values))
+
+    @classmethod
+    def from_frame(cls, df, resource, date_str=None):
+        """ Builds a series from a stored frame of timestamps followed by values. """
+        timestamps = pd.DatetimeIndex(df.iloc[:, 0])
+        if date_str is None and len(timestamps):
+            date_str = timestamps[0].strftime('%Y-%m-%d')
+        # Timestamps read back may not be in nanoseconds, so convert through the unit.
+        seconds = (timestamps - timestamps.normalize()).total_seconds().values.astype('int64')
+        return (cls(date_str, resource, seconds, df['value'].values))
+
+    def __len__(self):
+        return (len(self.values))
+
+    @property
+    def nbytes(self):
+        return (self.seconds.nbytes + self.values.nbytes)
+
+    def after(self, second):
+        """ Returns the samples later than the given second of day. """
+        keep = self.seconds > second
+        return (IntradaySeries(self.date_str, self.resource, self.seconds[keep], self.values[keep]))
+
+    def timestamps(self):
+        return (day_timestamps(self.date_str, self.seconds))
+
+    def to_frame(self, time_col='time'):
+        """ Returns the series as the two column frame the storage backends write. """
+        return (pd.DataFrame({time_col: self.timestamps(), 'value': self.values}))
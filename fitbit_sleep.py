@@ -0,0 +1,189 @@
+# /usr/bin/python3
+# -*- coding: utf-8 -*-
+# MIT License
+
+# Copyright (c) 2019 David Hunter
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+""" Heart rate during each stage of sleep.
+
+Sleep is reported against the day it ends on and holds one stage per minute
+for every sleep period of the night (the main sleep and any naps), but only
+as times of day.  The main sleep normally starts the evening before, so a
+night reported for 2019-01-02 holds minutes of both 2019-01-01 and
+2019-01-02 and has to be matched against the heart rate of both days.
+
+night_minutes puts the minutes of a night on one time line, in seconds from
+the midnight of the day the night is reported against (negative before
+midnight).  A run of consecutive minutes that reaches 23:59 while the night
+also has a run starting at 00:00 is the part of a period before midnight.
+align_night then finds the sleep minute of every heart rate sample with
+searchsorted on the sorted minute starts, so no heart rate x sleep frame is
+ever built, and night_stats summarizes the heart rate of each stage with a
+DaySketch.
+
+"""
+import numpy as numpy
+import pandas as pd
+
+from fitbit_daystats import DAY_STATS_COLUMNS, DaySketch
+
+# Stage values of the v1 sleep API (see get_sleep in fitbit-tracker.py).
+SLEEP_STAGES = {1: 'asleep', 2: 'restless', 3: 'awake'}
+SECONDS_PER_DAY = 86400
+MINUTE = 60
+SLEEP_HR_COLUMNS = ['Minutes'] + DAY_STATS_COLUMNS
+
+
+def night_minutes(seconds, stages):
+    """ Returns the minutes of a night on one time line.
+    Args:
+      seconds:  Seconds of day of each sleep minute, in any order
+      stages:   The stage of each minute
+    Returns:
+      The sorted int64 minute starts in seconds from the midnight of the day
+      the night is reported against, and their stages.
+    """
+    seconds = numpy.asarray(seconds).astype('int64')
+    stages = numpy.asarray(stages)
+    order = numpy.argsort(seconds, kind='stable')
+    seconds = seconds[order]
+    stages = stages[order]
+    if len(seconds) < 2:
+        return (seconds, stages)
+    breaks = numpy.flatnonzero(numpy.diff(seconds) != MINUTE)
+    if len(breaks) and seconds[0] < MINUTE and seconds[-1] >= SECONDS_PER_DAY - MINUTE:
+        # The last run continues into the first one past midnight, so it
+        # happened on the day before.
+        tail = breaks[-1] + 1
+        seconds = numpy.concatenate([seconds[tail:] - SECONDS_PER_DAY, seconds[:tail]])
+        stages = numpy.concatenate([stages[tail:], stages[:tail]])
+    return (seconds, stages)
+
+
+def align_night(minute_starts, stages, hr_seconds, hr_values):
+    """ Returns the heart rate samples that fall in a sleep minute and the stage of each.
+    Args:
+      minute_starts:  Sorted minute starts from night_minutes
+      stages:         The stage of each minute
+      hr_seconds:     Sorted seconds of the heart rate samples on the same time line
+      hr_values:      The heart rate samples
+    Returns:
+      A tuple of the seconds, values and stages of the samples during sleep.
+    """
+    hr_seconds = numpy.asarray(hr_seconds).astype('int64')
+    hr_values = numpy.asarray(hr_values)
+    if len(minute_starts) == 0 or len(hr_seconds) == 0:
+        return (hr_seconds[:0], hr_values[:0], numpy.asarray(stages)[:0])
+    # Only the samples between the first and last minute of the night are looked up.
+    first, last = numpy.searchsorted(hr_seconds, [minute_starts[0], minute_starts[-1] + MINUTE])
+    hr_seconds = hr_seconds[first:last]
+    hr_values = hr_values[first:last]
+    minute = numpy.searchsorted(minute_starts, hr_seconds, side='right') - 1
+    inside = hr_seconds < minute_starts[minute] + MINUTE
+    return (hr_seconds[inside], hr_values[inside], numpy.asarray(stages)[minute[inside]])
+
+
+def night_stats(minute_starts, stages, hr_seconds, hr_values):
+    """ Returns a frame of SLEEP_HR_COLUMNS with a row per stage of one night.
+    MinIdx and MaxIdx are the time of day of the first min and max.
+    """
+    seconds, values, sample_stages = align_night(minute_starts, stages, hr_seconds, hr_values)
+    rows = dict()
+    for stage in numpy.unique(stages):
+        sketch = DaySketch()
+        in_stage = sample_stages == stage
+        sketch.update(seconds[in_stage] % SECONDS_PER_DAY, values[in_stage])
+        row = sketch.row()
+        row['Minutes'] = int((stages == stage).sum())
+        rows[SLEEP_STAGES.get(int(stage), str(stage))] = row
+    return (pd.DataFrame.from_dict(rows, orient='index', columns=SLEEP_HR_COLUMNS))
+
+
+def frame_column(df, column, mask=None):
+    """ Returns the seconds of day and values present in a column of a wide frame. """
+    values = df[column].values
+    present = ~numpy.isnan(values)
+    if mask is not None:
+        present &= ~mask[column].values
+    seconds = df.index.total_seconds().values.astype('int64')
+    return (seconds[present], values[present].astype('int64'))
+
+
+def sleep_per_minute(sleep_df, date_list):
+    """ Puts the sleep stages of every night on a per-minute time line of days.
+    Args:
+      sleep_df:   Wide time of day x days frame of sleep stages, one column per
+                  night (the day it is reported against)
+      date_list:  The yyyy-mm-dd days of the time line
+    Returns:
+      A float32 array of len(date_list) * 1440 minutes, day after day, with
+      the stage of each minute or NaN.  The minutes a night spent before
+      midnight go on the day before the one it is reported against.
+    """
+    minutes_per_day = SECONDS_PER_DAY // MINUTE
+    positions = {day: position for position, day in enumerate(date_list)}
+    timeline = numpy.full(len(date_list) * minutes_per_day, numpy.nan, dtype='float32')
+    for night in sleep_df.columns:
+        sleep_seconds, sleep_stages = frame_column(sleep_df, night)
+        if len(sleep_seconds) == 0:
+            continue
+        minute_starts, stages = night_minutes(sleep_seconds, sleep_stages)
+        day_before = (pd.Timestamp(night) - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        for day, in_day in ((day_before, minute_starts < 0), (night, minute_starts >= 0)):
+            if day in positions and in_day.any():
+                minute = (minute_starts[in_day] % SECONDS_PER_DAY) // MINUTE
+                timeline[positions[day] * minutes_per_day + minute] = stages[in_day]
+    return (timeline)
+
+
+def sleep_heartrate(sleep_df, hr_df, hr_mask=None):
+    """ Returns the heart rate of each sleep stage of every night.
+    Args:
+      sleep_df:  Wide time of day x days frame of sleep stages
+      hr_df:     Wide time of day x days frame of heart rate
+      hr_mask:   Optional boolean frame of interpolated heart rate samples,
+                 which are left out
+    Returns:
+      A frame indexed by (night, stage) with the SLEEP_HR_COLUMNS.  A night
+      is matched against the heart rate of its own day and the day before;
+      days missing from hr_df only leave out their part of the night.
+    """
+    frames = dict()
+    for night in sleep_df.columns:
+        sleep_seconds, sleep_stages = frame_column(sleep_df, night)
+        if len(sleep_seconds) == 0:
+            continue
+        minute_starts, stages = night_minutes(sleep_seconds, sleep_stages)
+        day_before = (pd.Timestamp(night) - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        hr_seconds = list()
+        hr_values = list()
+        for day, offset in ((day_before, -SECONDS_PER_DAY), (night, 0)):
+            if day in hr_df.columns:
+                seconds, values = frame_column(hr_df, day, hr_mask)
+                hr_seconds.append(seconds + offset)
+                hr_values.append(values)
+        if not hr_seconds:
+            continue
+        frames[night] = night_stats(minute_starts, stages, numpy.concatenate(hr_seconds),
+                                    numpy.concatenate(hr_values))
+    if not frames:
+        return (pd.DataFrame(columns=SLEEP_HR_COLUMNS,
+                             index=pd.MultiIndex.from_tuples([], names=['night', 'stage'])))
+    return (pd.concat(frames, names=['night', 'stage']))
@@ -0,0 +1,113 @@
+# /usr/bin/python3
+# -*- coding: utf-8 -*-
+# MIT License
+
+# Copyright (c) 2019 David Hunter
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+""" NaN aware summary statistics of the merged day frames.
+
+The analysis summarizes the seconds x days frame along either axis with the
+mean, median, min, max, their positions and the standard deviation.  Asking
+pandas for each of these separately scans the frame seven times, and the
+median of columns holding NaN is the slowest of them.  nan_stats works on one
+contiguous copy of the data instead: a pass for the count, sum and sum of
+squares, an argmin and argmax, and a single in place sort from which the min,
+max and median are read at each slice's count of valid samples.
+
+Slices without any sample give NaN (and NaT/NaN positions) rather than the
+"All-NaN slice encountered" RuntimeWarning.
+
+"""
+import numpy as numpy
+import pandas as pd
+
+STATS_COLUMNS = ['Mean', 'Median', 'Min', 'Max', 'MinIdx', 'MaxIdx', 'StdDev']
+AXES = {0: 0, 'index': 0, 'rows': 0, 1: 1, 'columns': 1}
+
+
+def nan_stats(values, axis=0):
+    """ Returns the statistics of a 2D array along an axis, ignoring NaN.
+    Args:
+      values:  2D array of samples with NaN for missing values
+      axis:    The axis reduced (0 gives one result per column)
+    Returns:
+      A dict of STATS_COLUMNS to arrays.  MinIdx and MaxIdx hold the position
+      along axis of the first min and max, or -1 for slices without samples.
+    """
+    values = numpy.asarray(values)
+    dtype = numpy.result_type(values.dtype, numpy.float32)
+    # One C ordered copy with the reduced axis last, so every slice is contiguous.
+    work = numpy.array(numpy.moveaxis(values, AXES[axis], -1), dtype=dtype, order='C')
+    missing = numpy.isnan(work)
+    count = work.shape[-1] - missing.sum(axis=-1)
+    empty = count == 0
+
+    work[missing] = 0
+    total = work.sum(axis=-1, dtype='float64')
+    squares = numpy.einsum('ij,ij->i', work, work, dtype='float64')
+    work[missing] = -numpy.inf
+    max_idx = work.argmax(axis=-1)
+    work[missing] = numpy.inf
+    min_idx = work.argmin(axis=-1)
+    # Missing values are +inf, so after sorting the valid samples come first.
+    work.sort(axis=-1)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        variance = (squares - total * mean) / (count - 1)
+    std = numpy.sqrt(numpy.maximum(variance, 0))
+    std[count < 2] = numpy.nan
+    mean[empty] = numpy.nan
+
+    def sorted_at(positions):
+        positions = numpy.clip(positions, 0, work.shape[-1] - 1)
+        picked = numpy.take_along_axis(work, positions[:, None], axis=-1)[:, 0].astype('float64')
+        picked[empty] = numpy.nan
+        return (picked)
+
+    median = (sorted_at((count - 1) // 2) + sorted_at(count // 2)) / 2
+    min_idx[empty] = -1
+    max_idx[empty] = -1
+    return ({'Mean': mean, 'Median': median, 'Min': sorted_at(numpy.zeros_like(count)),
+             'Max': sorted_at(count - 1), 'MinIdx': min_idx, 'MaxIdx': max_idx, 'StdDev': std})
+
+
+def stats_frame(values, axis, labels, positions):
+    """ Returns nan_stats as a dataframe.
+    labels name the rows of the result (the entries along the kept axis) and
+    positions the entries along the reduced axis, used for MinIdx and MaxIdx.
+    """
+    stats = nan_stats(values, axis)
+    positions = pd.Index(positions)
+    stats_df = pd.DataFrame(index=pd.Index(labels))
+    for column in STATS_COLUMNS:
+        if column in ('MinIdx', 'MaxIdx'):
+            idx = stats[column]
+            stats_df[column] = pd.Series(positions.take(numpy.maximum(idx, 0))).mask(idx < 0).values
+        else:
+            stats_df[column] = stats[column]
+    return (stats_df)
+
+
+def frame_stats(df, axis):
+    """ Returns the statistics of a dataframe along an axis ('index' or 'columns'). """
+    if AXES[axis] == 0:
+        return (stats_frame(df.values, 0, df.columns, df.index))
+    return (stats_frame(df.values, 1, df.index, df.columns))
@@ -0,0 +1,705 @@
+# /usr/bin/python3
+# -*- coding: utf-8 -*-
+# MIT License
+
+# Copyright (c) 2019 David Hunter
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+""" Storage backends for the per-day data files written by fitbit-tracker.py
+
+The tracker stores one file per day per resource.  Historically these are csv
+files, which fitbit-analysis.py has to re-parse on every run.  The columnar
+backends store the same frames with native timestamps and narrow integer
+columns so they load without any text parsing:
+
+  csv      results/hr_intraday_2019-01-01.csv
+  parquet  results/parquet/resource=heartrate/year=2019/month=01/hr_intraday_2019-01-01.parquet
+  feather  results/feather/heartrate/hr_intraday_2019-01-01.feather
+
+The parquet layout uses hive style partition directories so a whole resource,
+year or month can be read with a single pd.read_parquet call.  Both columnar
+backends need the optional pyarrow package.
+
+Raw API responses saved with the tracker's --json option go to a JsonArchive.
+Each response is streamed through a compression codec (gzip, bz2 and xz from
+the standard library, zstd when the zstandard package is installed) either to
+its own file per day or appended to one bundle per resource per month:
+
+  day    results/hr_intraday_2019-01-01.json.gz
+  month  results/json_archive_heartrate_2019-01.jsonl.gz
+
+The archive can be read back with iter_payloads so data files can be rebuilt
+without calling the API.
+
+A FileCatalog maps each (resource, date) to its day file with the file's
+size, row count and mtime, so readers look days up in a dict instead of
+probing the directory for every date.  The tracker keeps it up to date as it
+writes; a directory without a catalog is scanned once with FileCatalog.scan, and
+readers rescan when the directory listing no longer matches the catalog.
+
+Existing csv directories can be converted with:
+
+  python fitbit_storage.py results --format parquet
+
+"""
+import argparse
+import bz2
+import glob
+import gzip
+import io
+import json
+import logging
+import lzma
+import os
+import re
+import sys
+import tempfile
+import threading
+
+import pandas as pd
+from tqdm import tqdm
+
+from fitbit_series import VALUE_DTYPES, narrow_values
+
+# resource: (file prefix, time column, value dtype)
+RESOURCES = {
+    'heartrate': ('hr_intraday_', 'time', VALUE_DTYPES['heartrate']),
+    'steps': ('steps_intraday_', 'time', VALUE_DTYPES['steps']),
+    'sleep': ('sleep_day_', 'dateTime', VALUE_DTYPES['sleep']),
+}
+
+DATE_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})')
+
+
+def get_resource(file_name):
+    """ Returns the resource a per-day file holds based on its name. """
+    base_name = os.path.basename(file_name)
+    for resource, (prefix, _, _) in RESOURCES.items():
+        if base_name.startswith(prefix):
+            return (resource)
+    raise ValueError('Unknown data file: ' + file_name)
+
+
+def get_date(file_name):
+    """ Returns the yyyy-mm-dd date embedded in a per-day file name. """
+    match = DATE_PATTERN.search(os.path.basename(file_name))
+    if match is None:
+        raise ValueError('No date in file name: ' + file_name)
+    return (match.group(1))
+
+
+def typed_frame(df, resource):
+    """ Returns the frame with a datetime64 time column and a narrow integer value column. """
+    _, time_col, dtype = RESOURCES[resource]
+    df = df.copy()
+    if not pd.api.types.is_datetime64_any_dtype(df[time_col]):
+        df[time_col] = pd.to_datetime(df[time_col])
+    df['value'] = narrow_values(pd.to_numeric(df['value']).values, dtype)
+    return (df[[time_col, 'value']])
+
+
+class CsvStorage(object):
+    """ One csv file per day per resource in the output directory.
+    If a FileCatalog is attached (attach_catalog), every day written is
+    recorded in it.
+    """
+    name = 'csv'
+    extension = '.csv'
+    catalog = None
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+    def path(self, resource, date_str):
+        """ Returns the file name used for a resource on a day. """
+        return (os.path.join(self.output_dir, RESOURCES[resource][0] + date_str + self.extension))
+
+    def pattern(self, resource):
+        """ Returns a glob pattern matching every day of a resource. """
+        return (os.path.join(self.output_dir, RESOURCES[resource][0] + '*' + self.extension))
+
+    def exists(self, resource, date_str):
+        return (os.path.exists(self.path(resource, date_str)))
+
+    def list_dates(self, resource):
+        """ Returns the sorted list of dates stored for a resource. """
+        return (sorted(get_date(f) for f in glob.glob(self.pattern(resource))))
+
+    def table_path(self, name):
+        """ Returns the file name used for a table that is not split by day. """
+        return (os.path.join(self.output_dir, name + self.extension))
+
+    def _write(self, df, file_name):
+        df.to_csv(file_name, header=True, index=False)
+
+    @classmethod
+    def read_table(cls, file_name):
+        return (pd.read_csv(file_name))
+
+    def write_atomic(self, df, file_name):
+        """ Writes a frame to a temporary file and renames it so readers never see a partial file. """
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(file_name) or '.', suffix=self.extension + '.tmp')
+        os.close(fd)
+        self._write(df.reset_index(drop=True), tmp_name)
+        os.replace(tmp_name, file_name)
+        return (file_name)
+
+    def attach_catalog(self):
+        """ Records every day written from now on in the backend's FileCatalog and returns it.
+        A directory without a catalog yet is scanned first, so the days already
+        stored are catalogued along with the ones written from now on.
+        """
+        self.catalog = FileCatalog(self)
+        if not self.catalog.exists() and os.path.isdir(self.output_dir):
+            self.catalog.scan()
+        return (self.catalog)
+
+    def write_day(self, resource, date_str, df, append=False):
+        """ Stores a day, or appends to it when append is set. """
+        file_name = self.path(resource, date_str)
+        if append:
+            df.to_csv(file_name, mode='a', header=False, index=False)
+        else:
+            df.to_csv(file_name, header=True, index=False)
+        if self.catalog is not None:
+            self.catalog.record(resource, date_str, len(df), append=append)
+        return (file_name)
+
+    @classmethod
+    def read_file(cls, file_name, resource):
+        return (typed_frame(pd.read_csv(file_name), resource))
+
+    def read_day(self, resource, date_str):
+        """ Returns the stored frame for a day with typed columns. """
+        return (self.read_file(self.path(resource, date_str), resource))
+
+    def day_info(self, resource, date_str):
+        """ Returns the number of samples stored and the HH:MM:SS of the last one.
+        Only the newlines and the tail of the file are read, not the values.
+        """
+        file_name = self.path(resource, date_str)
+        if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+            return (0, None)
+        rows = 0
+        with open(file_name, 'rb') as data_file:
+            for chunk in iter(lambda: data_file.read(1 << 20), b''):
+                rows += chunk.count(b'\n')
+            # Read back enough of the tail to find the last complete line.
+            data_file.seek(max(0, os.path.getsize(file_name) - 256))
+            last_line = data_file.read().decode('utf-8', 'replace').strip().split('\n')[-1]
+        rows -= 1  # header
+        if rows <= 0:
+            return (0, None)
+        return (rows, last_line.split(',')[0][-8:])
+
+
+class ColumnarStorage(CsvStorage):
+    """ Shared behaviour of the pyarrow based backends. """
+
+    def __init__(self, output_dir):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('The ' + self.name + ' storage backend requires the pyarrow package.')
+        CsvStorage.__init__(self, output_dir)
+
+    def write_day(self, resource, date_str, df, append=False):
+        """ Stores a day.  Appending rewrites the day file with the new rows added. """
+        file_name = self.path(resource, date_str)
+        df = typed_frame(df, resource)
+        if append and os.path.exists(file_name):
+            df = pd.concat([self.read_file(file_name, resource), df], ignore_index=True)
+        self.write_atomic(df, file_name)
+        if self.catalog is not None:
+            self.catalog.record(resource, date_str, len(df))
+        return (file_name)
+
+    def day_info(self, resource, date_str):
+        file_name = self.path(resource, date_str)
+        if not os.path.exists(file_name):
+            return (0, None)
+        df = self.read_file(file_name, resource)
+        if df.empty:
+            return (0, None)
+        return (len(df), df.iloc[-1, 0].strftime('%H:%M:%S'))
+
+
+class ParquetStorage(ColumnarStorage):
+    """ Parquet files partitioned by resource, year and month. """
+    name = 'parquet'
+    extension = '.parquet'
+
+    def path(self, resource, date_str):
+        year, month, _ = date_str.split('-')
+        return (os.path.join(self.output_dir, 'parquet', 'resource=' + resource, 'year=' + year,
+                             'month=' + month, RESOURCES[resource][0] + date_str + self.extension))
+
+    def pattern(self, resource):
+        return (os.path.join(self.output_dir, 'parquet', 'resource=' + resource, 'year=*', 'month=*',
+                             RESOURCES[resource][0] + '*' + self.extension))
+
+    def table_path(self, name):
+        return (os.path.join(self.output_dir, 'parquet', name + self.extension))
+
+    def _write(self, df, file_name):
+        df.to_parquet(file_name, engine='pyarrow', index=False)
+
+    @classmethod
+    def read_file(cls, file_name, resource):
+        return (pd.read_parquet(file_name, engine='pyarrow'))
+
+    @classmethod
+    def read_table(cls, file_name):
+        return (pd.read_parquet(file_name, engine='pyarrow'))
+
+    def day_info(self, resource, date_str):
+        # The row count is in the file footer, so only the time column is read.
+        import pyarrow.parquet as pq
+        file_name = self.path(resource, date_str)
+        if not os.path.exists(file_name):
+            return (0, None)
+        time_col = pq.read_table(file_name, columns=[RESOURCES[resource][1]]).column(0)
+        if len(time_col) == 0:
+            return (0, None)
+        return (len(time_col), time_col[-1].as_py().strftime('%H:%M:%S'))
+
+
+class FeatherStorage(ColumnarStorage):
+    """ One feather file per day in a directory per resource. """
+    name = 'feather'
+    extension = '.feather'
+
+    def path(self, resource, date_str):
+        return (os.path.join(self.output_dir, 'feather', resource,
+                             RESOURCES[resource][0] + date_str + self.extension))
+
+    def pattern(self, resource):
+        return (os.path.join(self.output_dir, 'feather', resource, RESOURCES[resource][0] + '*' + self.extension))
+
+    def table_path(self, name):
+        return (os.path.join(self.output_dir, 'feather', name + self.extension))
+
+    def _write(self, df, file_name):
+        df.to_feather(file_name)
+
+    @classmethod
+    def read_file(cls, file_name, resource):
+        return (pd.read_feather(file_name))
+
+    @classmethod
+    def read_table(cls, file_name):
+        return (pd.read_feather(file_name))
+
+
+BACKENDS = {'csv': CsvStorage, 'parquet': ParquetStorage, 'feather': FeatherStorage}
+
+
+def get_storage(name, output_dir):
+    """ Returns the storage backend with the given name. """
+    if name not in BACKENDS:
+        raise ValueError('Unknown storage backend ' + str(name) + '.  Use one of ' + ', '.join(BACKENDS))
+    return (BACKENDS[name](output_dir))
+
+
+class DailyTable(object):
+    """ A table with one row per day keyed by the yyyy-mm-dd date.
+
+    Rows are added with update, which replaces the values already stored for
+    the same dates and keeps everything else, so a range can be collected
+    again without creating duplicates.  The table is small (a row per day) so
+    each update rewrites it atomically.
+    Args:
+      storage:  The storage backend deciding the file format and location
+      name:     Name of the table file without extension
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.file_name = storage.table_path(name)
+
+    def read(self):
+        """ Returns the stored table indexed by date, empty if there is none yet. """
+        if not os.path.exists(self.file_name):
+            return (pd.DataFrame(index=pd.Index([], name='date', dtype=object)))
+        df = self.storage.read_table(self.file_name)
+        df['date'] = df['date'].astype(str)
+        return (df.set_index('date'))
+
+    def update(self, df):
+        """ Adds or replaces the rows of a frame indexed by yyyy-mm-dd date. """
+        df = df.copy()
+        df.index = df.index.astype(str).rename('date')
+        with self._lock:
+            stored = self.read()
+            if len(stored):
+                df = df.combine_first(stored)
+            self.storage.write_atomic(df.sort_index().reset_index(), self.file_name)
+        return (self.file_name)
+
+
+class FileCatalog(object):
+    """ Index of the day files of a storage backend keyed by (resource, date).
+
+    Each line of the catalog file is a JSON object with the resource, date,
+    file name (relative to the output directory), size, row count and mtime
+    of a day file.  Like the CheckpointJournal it is append only and the last
+    entry for a day wins, so the writer only appends a line per day written.
+    The row count is None for files found by scan that have not been written
+    since.  scan rewrites the catalog from the files on disk.
+    Args:
+      storage:  The storage backend whose files are catalogued
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.file_name = os.path.join(storage.output_dir, 'fitbit-catalog-' + storage.name + '.jsonl')
+        self.entries = dict()
+        self.load()
+
+    def exists(self):
+        return (os.path.exists(self.file_name))
+
+    def load(self):
+        """ Reads the catalog, ignoring a partially written last line. """
+        self.entries = dict()
+        if not self.exists():
+            return (self.entries)
+        with open(self.file_name) as catalog:
+            for line in catalog:
+                try:
+                    entry = json.loads(line)
+                    self.entries[(entry['resource'], entry['date'])] = entry
+                except (ValueError, KeyError):
+                    logging.warning('Skipping unreadable catalog entry: ' + line.strip())
+        return (self.entries)
+
+    def _entry(self, resource, date_str, file_name, rows):
+        stat = os.stat(file_name)
+        return ({'resource': resource, 'date': date_str,
+                 'file': os.path.relpath(file_name, self.storage.output_dir),
+                 'size': stat.st_size, 'rows': rows, 'mtime': stat.st_mtime})
+
+    def record(self, resource, date_str, rows, append=False):
+        """ Records a day file that has just been written with rows rows, or rows more if append. """
+        with self._lock:
+            if append:
+                previous = self.entries.get((resource, date_str))
+                if previous is None or previous['rows'] is None:
+                    rows = None
+                else:
+                    rows = previous['rows'] + rows
+            entry = self._entry(resource, date_str, self.storage.path(resource, date_str), rows)
+            self.entries[(resource, date_str)] = entry
+            with open(self.file_name, 'a') as catalog:
+                catalog.write(json.dumps(entry) + '\n')
+        return (entry)
+
+    def listing(self):
+        """ Returns the set of (resource, date) of the day files on disk, from one glob per resource. """
+        return (set((resource, get_date(f)) for resource in RESOURCES for f in glob.glob(self.storage.pattern(resource))))
+
+    def is_stale(self):
+        """ Returns True if day files were added or removed without being recorded.
+        Only the directory is listed, the files are not opened or stat'ed.
+        """
+        return (self.listing() != set(self.entries))
+
+    def scan(self):
+        """ Rebuilds the catalog from one directory listing per resource.
+        Row counts are kept for files whose size and mtime have not changed.
+        Returns the number of files catalogued.
+        """
+        entries = dict()
+        for resource in RESOURCES:
+            for file_name in glob.glob(self.storage.pattern(resource)):
+                date_str = get_date(file_name)
+                previous = self.entries.get((resource, date_str))
+                entry = self._entry(resource, date_str, file_name, None)
+                if previous is not None and (previous['size'], previous['mtime']) == (entry['size'], entry['mtime']):
+                    entry['rows'] = previous['rows']
+                entries[(resource, date_str)] = entry
+        with self._lock:
+            fd, tmp_name = tempfile.mkstemp(dir=self.storage.output_dir, suffix='.jsonl.tmp')
+            with os.fdopen(fd, 'w') as catalog:
+                for key in sorted(entries):
+                    catalog.write(json.dumps(entries[key]) + '\n')
+            os.replace(tmp_name, self.file_name)
+            self.entries = entries
+        logging.info('Catalogued ' + str(len(entries)) + ' files in ' + self.file_name)
+        return (len(entries))
+
+    def get(self, resource, date_str):
+        """ Returns the entry of a day, or None if the day has no file. """
+        return (self.entries.get((resource, date_str)))
+
+    def path(self, resource, date_str):
+        """ Returns the full file name of a day, or None if the day has no file. """
+        entry = self.entries.get((resource, date_str))
+        if entry is None:
+            return (None)
+        return (os.path.join(self.storage.output_dir, entry['file']))
+
+    def dates(self, resource):
+        """ Returns the sorted list of dates catalogued for a resource. """
+        return (sorted(d for r, d in self.entries if r == resource))
+
+
+def read_data_file(file_name):
+    """ Reads a per-day file written by any backend, based on its extension. """
+    resource = get_resource(file_name)
+    for backend in BACKENDS.values():
+        if file_name.endswith(backend.extension):
+            return (backend.read_file(file_name, resource))
+    raise ValueError('Unknown data file: ' + file_name)
+
+
+def get_zstd_module():
+    """ Returns whichever zstd module is available (stdlib on 3.14+, else zstandard). """
+    try:
+        from compression import zstd
+        return (zstd)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('The zstd codec requires the zstandard package.')
+    return (zstandard)
+
+
+def open_zstd(file_name, mode):
+    """ Opens a zstd compressed file. """
+    return (get_zstd_module().open(file_name, mode))
+
+
+# codec: (open function, file extension)
+CODECS = {
+    'none': (open, ''),
+    'gzip': (gzip.open, '.gz'),
+    'bz2': (bz2.open, '.bz2'),
+    'xz': (lzma.open, '.xz'),
+    'zstd': (open_zstd, '.zst'),
+}
+
+ARCHIVE_PATTERN = re.compile(r'^(?P<prefix>[a-z_]+?)(?P<date>\d{4}-\d{2}-\d{2})(?:_(?P<time>\d{6}))?\.json'
+                             r'(?P<ext>\.gz|\.bz2|\.xz|\.zst)?$')
+BUNDLE_PATTERN = re.compile(r'^json_archive_(?P<resource>[a-z]+)_(?P<month>\d{4}-\d{2})\.jsonl'
+                            r'(?P<ext>\.gz|\.bz2|\.xz|\.zst)?$')
+
+
+def get_codec(file_name):
+    """ Returns the codec used by an archive file based on its extension. """
+    for codec, (_, ext) in CODECS.items():
+        if ext and file_name.endswith(ext):
+            return (codec)
+    return ('none')
+
+
+class JsonArchive(object):
+    """ Stores the raw API responses, compressed, per day or bundled per month.
+    Args:
+      output_dir:  Directory to hold the archive files
+      codec:       One of CODECS
+      bundle:      'day' for a file per response or 'month' to append every
+                   response of a resource in a month to a single file
+    """
+
+    def __init__(self, output_dir, codec='gzip', bundle='day'):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec ' + str(codec) + '.  Use one of ' + ', '.join(CODECS))
+        if bundle not in ('day', 'month'):
+            raise ValueError('Unknown bundle ' + str(bundle) + '.  Use day or month')
+        if codec == 'zstd':
+            # Fail now rather than on the first write.
+            get_zstd_module()
+        self.output_dir = output_dir
+        self.codec = codec
+        self.bundle = bundle
+        self._locks = dict()
+        self._locks_lock = threading.Lock()
+
+    def _lock(self, file_name):
+        with self._locks_lock:
+            if file_name not in self._locks:
+                self._locks[file_name] = threading.Lock()
+            return (self._locks[file_name])
+
+    def path(self, resource, date_str, last_time=None):
+        """ Returns the archive file a response is written to. """
+        ext = CODECS[self.codec][1]
+        if self.bundle == 'month':
+            return (os.path.join(self.output_dir, 'json_archive_' + resource + '_' + date_str[:7] + '.jsonl' + ext))
+        name = RESOURCES[resource][0] + date_str
+        if last_time is not None:
+            # Keep top-up responses separate from the full day.
+            name = name + '_' + last_time.replace(':', '')
+        return (os.path.join(self.output_dir, name + '.json' + ext))
+
+    def write(self, resource, date_str, payload, last_time=None):
+        """ Streams a response into the archive and returns the file name. """
+        file_name = self.path(resource, date_str, last_time)
+        opener = CODECS[self.codec][0]
+        if self.bundle == 'month':
+            # Compressed streams can be concatenated, so each response is
+            # appended as its own member holding one json line.
+            entry = {'resource': resource, 'date': date_str, 'last_time': last_time, 'payload': payload}
+            with self._lock(file_name):
+                with opener(file_name, 'ab') as raw:
+                    with io.TextIOWrapper(raw, encoding='utf-8') as text:
+                        json.dump(entry, text)
+                        text.write('\n')
+        else:
+            with opener(file_name, 'wb') as raw:
+                with io.TextIOWrapper(raw, encoding='utf-8') as text:
+                    json.dump(payload, text)
+        return (file_name)
+
+
+def parse_archive_name(file_name):
+    """ Returns (resource, date_str, last_time) for a day archive file, or None.
+    For a monthly bundle date_str is the yyyy-mm month and last_time is None.
+    """
+    base_name = os.path.basename(file_name)
+    prefixes = {prefix: name for name, (prefix, _, _) in RESOURCES.items()}
+    match = ARCHIVE_PATTERN.match(base_name)
+    if match and match.group('prefix') in prefixes:
+        last_time = match.group('time')
+        if last_time is not None:
+            last_time = last_time[0:2] + ':' + last_time[2:4] + ':' + last_time[4:6]
+        return (prefixes[match.group('prefix')], match.group('date'), last_time)
+    match = BUNDLE_PATTERN.match(base_name)
+    if match and match.group('resource') in RESOURCES:
+        return (match.group('resource'), match.group('month'), None)
+    return (None)
+
+
+def iter_archive_file(file_name, resource=None, start_date=None, end_date=None):
+    """ Yields (resource, date_str, last_time, payload) for each response in one archive file. """
+    parsed = parse_archive_name(file_name)
+    if parsed is None:
+        return
+
+    def wanted(res, date_str):
+        return ((resource is None or res == resource) and
+                (start_date is None or date_str >= start_date) and
+                (end_date is None or date_str <= end_date))
+
+    opener = CODECS[get_codec(file_name)][0]
+    if BUNDLE_PATTERN.match(os.path.basename(file_name)):
+        if resource is not None and parsed[0] != resource:
+            return
+        with opener(file_name, 'rb') as raw:
+            for line in io.TextIOWrapper(raw, encoding='utf-8'):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if wanted(entry['resource'], entry['date']):
+                    yield (entry['resource'], entry['date'], entry.get('last_time'), entry['payload'])
+    elif wanted(parsed[0], parsed[1]):
+        with opener(file_name, 'rb') as raw:
+            yield (parsed[0], parsed[1], parsed[2], json.load(raw))
+
+
+def group_archive_files(archive_dir):
+    """ Groups the archive files so each group can be replayed independently.
+
+    Day files for the same resource and day (the full day and any top-ups)
+    form one group in the order they were written.  Each monthly bundle is a
+    group of its own.
+    """
+    groups = dict()
+    for file_name in sorted(os.listdir(archive_dir)):
+        parsed = parse_archive_name(file_name)
+        if parsed is None:
+            continue
+        if BUNDLE_PATTERN.match(file_name):
+            key = file_name
+        else:
+            key = (parsed[0], parsed[1])
+        groups.setdefault(key, list()).append(os.path.join(archive_dir, file_name))
+    # A full day name sorts before its top-ups ('.' < '_'), so order is kept.
+    return (list(groups.values()))
+
+
+def iter_payloads(archive_dir, resource=None, start_date=None, end_date=None):
+    """ Yields every archived response, whatever codec or bundling wrote it.
+    Args:
+      archive_dir:  Directory holding the archive files
+      resource:     Only yield this resource (default: all)
+      start_date:   Only yield days on or after this yyyy-mm-dd date
+      end_date:     Only yield days on or before this yyyy-mm-dd date
+    Yields:
+      Tuples of (resource, date_str, last_time, payload) ordered by file name.
+    """
+    for group in group_archive_files(archive_dir):
+        for file_name in group:
+            for entry in iter_archive_file(file_name, resource, start_date, end_date):
+                yield (entry)
+
+
+def convert_directory(source, dest, resources=None):
+    """ Copies every day stored in one backend into another.
+    Args:
+      source:     The storage to read from
+      dest:       The storage to write to
+      resources:  List of resources to convert (default: all)
+    Returns:
+      The number of day files converted.
+    """
+    if resources is None:
+        resources = list(RESOURCES)
+    count = 0
+    for resource in resources:
+        date_list = source.list_dates(resource)
+        for date_str in tqdm(date_list, desc='Converting ' + resource, ascii=True):
+            dest.write_day(resource, date_str, source.read_day(resource, date_str))
+            count += 1
+    logging.info('Converted ' + str(count) + ' files from ' + source.name + ' to ' + dest.name)
+    return (count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Fitbit Storage',
+        description='Converts a directory of fitbit-tracker.py csv files to a columnar format.')
+    parser.add_argument('output_dir', help='Directory holding the csv files', type=str)
+    parser.add_argument('-f', '--format', help='Storage format to convert to (default: %(default)s)',
+                        choices=['parquet', 'feather'], default='parquet', dest='storage')
+    parser.add_argument('-t', '--type', help='Only convert the type of data specified (heartrate, sleep, steps)',
+                        action='store', type=str, dest='collect_type')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output_dir):
+        print('The output directory ' + str(args.output_dir) + ' does not exist.')
+        sys.exit(1)
+    try:
+        dest = get_storage(args.storage, args.output_dir)
+    except ImportError as err:
+        print(str(err))
+        sys.exit(1)
+    dest.attach_catalog()
+    if args.collect_type:
+        resources = [r for r in RESOURCES if r in args.collect_type]
+    else:
+        resources = None
+    count = convert_directory(CsvStorage(args.output_dir), dest, resources)
+    print('Converted ' + str(count) + ' files.')